@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+
+# Micro-benchmarks for the STEP XML to JSON converter (xmlToJson.py)
+
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+import json
+import logging
+import math
+import os
+from os.path import join
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import xmlToJson
+from xmlToJson import CONFIG, CACHE_CONFIG, INDEXING, bulk_index, make_index
+from xmlToJson import np
+
+# settings of the levels of detail, which are not benchmarked
+LOD_CONFIG = ('lodLevels', 'lodCells')
+
+#------------------------------------------------------------------------------
+
+
+def synthetic_shell(triangles, vertices, seed=0):
+    """Generate the unindexed point and normal data of a large shell.  Facets
+    share vertices, so rounded values repeat much like a real tessellation"""
+    rng = random.Random(seed)
+    coord = lambda: rng.uniform(-500.0, 500.0)
+    verts = [(coord(), coord(), coord()) for _ in xrange(vertices)]
+    points = []
+    normals = []
+    for _ in xrange(triangles):
+        normal = [rng.uniform(-1.0, 1.0) for _ in xrange(3)]
+        for _ in xrange(3):
+            points.extend(verts[rng.randrange(vertices)])
+            normals.extend(normal)
+    return {'points': points, 'normals': normals}
+
+
+def timed(func, *args):
+    """Run func once, returning its elapsed time in seconds"""
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def index_legacy(data, ikeys):
+    """The per-scalar dict indexing used when NumPy is not available"""
+    data['values'] = {}
+    for ikey in ikeys:
+        make_index(data, ikey)
+    values = data['values']
+    data['values'] = sorted(values, key=values.get)
+
+
+def bench_index(args):
+    """Compare make_index with bulk_index on one large shell"""
+    if np is None:
+        print "bulk_index requires NumPy"
+        return 1
+    CONFIG['roundPrecision'] = args.precision
+    ikeys = [ikey for _, ikey in INDEXING]
+    source = synthetic_shell(args.triangles, args.vertices)
+    legacy = dict(source)
+    bulk = {k: np.array(v) for k, v in source.items()}
+    legacy_time = timed(index_legacy, legacy, ikeys)
+    bulk_time = timed(bulk_index, bulk, ikeys)
+    if legacy != bulk:
+        print "bulk_index output differs from make_index"
+        return 1
+    print "Triangles: {} Values: {}".format(
+        args.triangles, len(legacy['values']))
+    print "make_index: {:.3f} secs".format(legacy_time)
+    print "bulk_index: {:.3f} secs".format(bulk_time)
+    print "Speedup: {:.1f}x".format(legacy_time / max(bulk_time, 1e-9))
+    return 0
+
+
+#------------------------------------------------------------------------------
+
+def surface_shell(rng, shell_id, origin, triangles, palette, runs):
+    """The XML of a shell tessellating a wavy patch, with smooth normals and
+    its facets in runs of colors from the palette.  Returns the XML, the
+    bbox and the number of facets"""
+    cols = int(math.ceil(math.sqrt(triangles / 2.0))) + 1
+    rows = int(math.ceil(triangles / (2.0 * (cols - 1)))) + 1
+    step = rng.uniform(0.5, 2.0)
+    amp = rng.uniform(1.0, 10.0)
+    freq = rng.uniform(0.05, 0.5)
+    points = []
+    normals = []
+    for i in xrange(rows):
+        for j in xrange(cols):
+            x = origin[0] + j * step
+            y = origin[1] + i * step
+            z = origin[2] + amp * math.sin(x * freq) * math.cos(y * freq)
+            dx = amp * freq * math.cos(x * freq) * math.cos(y * freq)
+            dy = -amp * freq * math.sin(x * freq) * math.sin(y * freq)
+            length = math.sqrt(dx * dx + dy * dy + 1.0)
+            points.append((x, y, z))
+            normals.append('%.6g %.6g %.6g' % (-dx / length, -dy / length,
+                                               1.0 / length))
+    facets = []
+    for i in xrange(rows - 1):
+        for j in xrange(cols - 1):
+            a = i * cols + j
+            facets.append((a, a + 1, a + cols + 1))
+            facets.append((a, a + cols + 1, a + cols))
+    facets = facets[:triangles]
+    lines = ['<shell id="%s" color="%s">' % (shell_id, palette[0]),
+             '<verts>']
+    lines.extend('<v p="%.9g %.9g %.9g"/>' % p for p in points)
+    lines.append('</verts>')
+    run = int(math.ceil(len(facets) / float(runs)))
+    for start in xrange(0, len(facets), run):
+        # the first run keeps the color of the shell
+        color = start and ' color="%s"' % rng.choice(palette) or ''
+        lines.append('<facets%s>' % color)
+        for f in facets[start:start + run]:
+            lines.append('<f v="%d %d %d">' % f)
+            lines.extend('<n d="%s"/>' % normals[v] for v in f)
+            lines.append('</f>')
+        lines.append('</facets>')
+    lines.append('</shell>')
+    lows = [min(p[k] for p in points) for k in xrange(3)]
+    highs = [max(p[k] for p in points) for k in xrange(3)]
+    return '\n'.join(lines), lows + highs, len(facets)
+
+
+def generate_model(path, args):
+    """Write a synthetic STEP XML model: a chain of shapes nested depth deep,
+    the shells and annotations dealt out among them, each shell and
+    annotation an external file.  Returns the bytes written"""
+    rng = random.Random(args.seed)
+    palette = ['%06x' % rng.randrange(1 << 24) for _ in xrange(args.colors)]
+    shells = [[] for _ in xrange(args.depth)]
+    annotations = [[] for _ in xrange(args.depth)]
+    lines = ['<step-assembly root="p0">',
+             '<product id="p0" name="benchmark" shape="s0"/>']
+    for n in xrange(args.shells):
+        shell_id = 'sh%d' % n
+        origin = (n % 10 * 200.0, n // 10 * 200.0, n % args.depth * 50.0)
+        xml, bbox, size = surface_shell(rng, shell_id, origin,
+                                        args.triangles, palette, args.runs)
+        href = 'shell_%s.xml' % shell_id
+        with open(join(path, href), 'w') as f:
+            f.write(xml)
+        lines.append('<shell id="%s" size="%d" bbox="%s" href="%s"/>' % (
+            shell_id, size, ' '.join('%.9g' % x for x in bbox), href))
+        shells[n % args.depth].append(shell_id)
+    for n in xrange(args.annotations):
+        annotation_id = 'a%d' % n
+        href = 'annotation_%s.xml' % annotation_id
+        polyline = ''.join(
+            '<p l="%.9g %.9g %.9g"/>' % tuple(
+                rng.uniform(-500.0, 500.0) for _ in xrange(3))
+            for _ in xrange(100))
+        with open(join(path, href), 'w') as f:
+            f.write('<annotation id="%s"><polyline>%s</polyline>'
+                    '</annotation>' % (annotation_id, polyline))
+        lines.append('<annotation id="%s" href="%s"/>' % (annotation_id,
+                                                          href))
+        annotations[n % args.depth].append(annotation_id)
+    for level in xrange(args.depth):
+        attrib = ''
+        if shells[level]:
+            attrib += ' shell="%s"' % ' '.join(shells[level])
+        if annotations[level]:
+            attrib += ' annotation="%s"' % ' '.join(annotations[level])
+        child = ''
+        if level + 1 < args.depth:
+            child = ('<child ref="s%d" xform="1 0 0 0 0 1 0 0 0 0 1 0 '
+                     '10 20 30 1"/>' % (level + 1))
+        lines.append('<shape id="s%d"%s>%s</shape>' % (level, attrib, child))
+    lines.append('</step-assembly>')
+    with open(join(path, 'index.xml'), 'w') as f:
+        f.write('\n'.join(lines))
+    return sum(os.path.getsize(join(path, x)) for x in os.listdir(path))
+
+
+def peak_rss():
+    """Peak resident set size of the process so far, in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def staged(stages, name, func, *args):
+    """Run func once as a named stage, recording its elapsed time and the
+    peak RSS of the process so far, which a stage only shows once it
+    raises it.  Returns what func returns"""
+    start = time.time()
+    result = func(*args)
+    stages[name] = {'secs': round(time.time() - start, 6),
+                    'peakRssSoFar': peak_rss()}
+    return result
+
+
+def parse_model(path):
+    """Parse the index of a model and the files it refers to"""
+    index = xmlToJson.parse_xml(join(path, 'index.xml')).getroot()
+    shells = [xmlToJson.parse_xml(join(path, x.attrib['href'])).getroot()
+              for x in index.iter('shell')]
+    annotations = [
+        xmlToJson.parse_xml(join(path, x.attrib['href'])).getroot()
+        for x in index.iter('annotation')]
+    return index, shells, annotations
+
+
+def translate_model(model, use_tyson):
+    """Translate the parsed index, annotations and shells, the shells up to
+    their layout"""
+    index, shells, annotations = model
+    data = []
+    for shell in shells:
+        shell_data = xmlToJson.new_shell(shell.attrib)
+        xmlToJson.layout_shell(shell_data, xmlToJson.shell_geometry(shell))
+        data.append(shell_data)
+    return (xmlToJson.translate_index(index, use_tyson), data,
+            [xmlToJson.translate_annotation(x) for x in annotations])
+
+
+def index_shells(shells):
+    """Index the values of each shell"""
+    for shell in shells:
+        xmlToJson.index_shell(shell)
+
+
+def compress_colors(shells):
+    """Compress the colors of each shell, if configured"""
+    if CONFIG.get('compressColors'):
+        for shell in shells:
+            xmlToJson.compress_shell_colors(shell)
+
+
+def batch_shells(index, shells, sizes, args):
+    """Plan the batches from the sizes of the shell XML, as the converter
+    does when pipelining, and fill each with its shells in the planned
+    order.  Returns the batches and the shell bboxes"""
+    translator = xmlToJson.XMLTranslator(
+        batches=args.batches, batch_bytes=args.batch_bytes,
+        spatial=args.spatial)
+    translator.index = index
+    bboxes = translator.shell_bboxes(index['shells'])
+    plan = translator.get_batches(sizes)
+    reindex = xmlToJson.batch_reindex({'reindex': args.reindex})
+    by_name = dict(('shell_%s.json' % x['id'], x) for x in shells)
+    result = []
+    for i in xrange(len(plan)):
+        batch = xmlToJson.new_batch(reindex)
+        for name in plan['batch%s' % i]['shells']:
+            shell = by_name[name]
+            xmlToJson.plain_values(shell)
+            xmlToJson.add_to_batch(batch, shell)
+        result.append(xmlToJson.finish_batch(batch))
+    return result, bboxes
+
+
+def encode_model(path, index, annotations, batches, bboxes, use_tyson):
+    """Write the index, annotations and batches of a model, returning any
+    errors"""
+    reasons = []
+    with xmlToJson.OutputFile(join(path, 'index.json')) as f:
+        json.dump(index, f)
+    for annotation in annotations:
+        name = 'annotation_%s.json' % annotation['id']
+        with xmlToJson.OutputFile(join(path, name)) as f:
+            json.dump(annotation, f)
+    for n, batch in enumerate(batches):
+        job = {'use_tyson': use_tyson, 'name': 'batch%d' % n, 'path': path,
+               'bboxes': bboxes}
+        xmlToJson.write_batch(job, batch, reasons)
+    return reasons
+
+
+def bench_model(args):
+    """Time each stage of converting a synthetic model"""
+    for key, value in args.config:
+        CONFIG[key] = value
+    xmlToJson.LOG.setLevel(logging.WARNING)
+    path = args.keep or tempfile.mkdtemp(prefix='benchmark')
+    out = join(path, 'out')
+    for d in (path, out):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    try:
+        input_bytes = generate_model(path, args)
+        sizes = [(x[:-len('.xml')] + '.json', os.path.getsize(join(path, x)))
+                 for x in sorted(os.listdir(path)) if x.startswith('shell_')]
+        stages = OrderedDict()
+        model = staged(stages, 'parse', parse_model, path)
+        index, shells, annotations = staged(
+            stages, 'translate', translate_model, model, args.tyson)
+        del model
+        staged(stages, 'index', index_shells, shells)
+        staged(stages, 'colors', compress_colors, shells)
+        batches, bboxes = staged(stages, 'batch', batch_shells, index,
+                                 shells, sizes, args)
+        reasons = staged(stages, 'encode', encode_model, out, index,
+                         annotations, batches, bboxes, args.tyson)
+        output_bytes = sum(os.path.getsize(join(out, x))
+                           for x in os.listdir(out))
+    finally:
+        if not args.keep:
+            shutil.rmtree(path)
+    for reason in reasons:
+        print >> sys.stderr, reason
+    result = OrderedDict([
+        ('benchmark', 'model'),
+        ('date', datetime.utcnow().isoformat()),
+        ('python', platform.python_version()),
+        ('numpy', np is not None and np.__version__ or None),
+        ('model', OrderedDict([
+            ('shells', args.shells),
+            ('triangles', args.triangles),
+            ('colors', args.colors),
+            ('runs', args.runs),
+            ('depth', args.depth),
+            ('annotations', args.annotations),
+            ('seed', args.seed)])),
+        ('config', OrderedDict(
+            (k, CONFIG[k]) for k in CACHE_CONFIG + ('deltaArrays',)
+            if k not in LOD_CONFIG)),
+        ('tyson', args.tyson),
+        ('reindex', args.reindex),
+        ('spatial', args.spatial),
+        ('batchBytes', args.batch_bytes),
+        ('batches', len(batches)),
+        ('stages', stages),
+        ('secs', round(sum(x['secs'] for x in stages.values()), 6)),
+        ('peakRss', peak_rss()),
+        ('inputBytes', input_bytes),
+        ('outputBytes', output_bytes)
+    ])
+    line = json.dumps(result)
+    print line
+    if args.output:
+        # one result per line, so runs can be tracked over time
+        with open(args.output, 'a') as f:
+            f.write(line + '\n')
+    return 1 if reasons else 0
+
+
+def config_item(item):
+    """Parse a KEY=VALUE override of a CONFIG setting, the value as JSON"""
+    key, _, value = item.partition('=')
+    if key not in CONFIG:
+        raise argparse.ArgumentTypeError("unknown setting '%s'" % key)
+    if key in LOD_CONFIG:
+        raise argparse.ArgumentTypeError("'%s' is not benchmarked" % key)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("bad value for '%s'" % key)
+
+
+#------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='benchmark.py',
+        description="Benchmarks the STEP XML to JSON converter")
+    commands = parser.add_subparsers()
+
+    index = commands.add_parser("index", help="value indexing")
+    h = "number of triangles in the shell"
+    index.add_argument("--triangles", type=int, default=1000000, help=h)
+    h = "number of distinct vertices in the shell"
+    index.add_argument("--vertices", type=int, default=200000, help=h)
+    h = "rounding precision"
+    index.add_argument("--precision", type=int, default=2, help=h)
+    index.set_defaults(func=bench_index)
+
+    model = commands.add_parser(
+        "model", help="each stage of converting a synthetic model")
+    h = "number of shells"
+    model.add_argument("--shells", type=int, default=20, help=h)
+    h = "number of triangles per shell"
+    model.add_argument("--triangles", type=int, default=10000, help=h)
+    h = "number of distinct colors"
+    model.add_argument("--colors", type=int, default=4, help=h)
+    h = "number of facet groups per shell, each of one color"
+    model.add_argument("--runs", type=int, default=4, help=h)
+    h = "depth of the nested shapes"
+    model.add_argument("--depth", type=int, default=3, help=h)
+    h = "number of annotations"
+    model.add_argument("--annotations", type=int, default=2, help=h)
+    batching = model.add_mutually_exclusive_group()
+    h = "number of batches"
+    batching.add_argument("--batches", type=int, default=1, help=h)
+    h = "batches of about this size, e.g. 4MB"
+    batching.add_argument("--batch-bytes", type=xmlToJson.parse_bytes,
+                          help=h)
+    h = "batch shells that are near each other"
+    model.add_argument("--spatial", action="store_true", help=h)
+    h = "random seed of the model"
+    model.add_argument("--seed", type=int, default=0, help=h)
+    h = "share one value table per batch"
+    model.add_argument("--reindex", action="store_true", help=h)
+    h = "encode batches as TySON"
+    model.add_argument("--tyson", action="store_true", help=h)
+    h = "override a CONFIG setting, the value as JSON, e.g. quantizeBits=16"
+    model.add_argument("--config", type=config_item, action="append",
+                       default=[], metavar="KEY=VALUE", help=h)
+    h = "append the result to a file of JSON lines"
+    model.add_argument("--output", help=h)
+    h = "generate the model in a directory and keep it"
+    model.add_argument("--keep", metavar="DIR", help=h)
+    model.set_defaults(func=bench_model)
+
+    args = parser.parse_args()
+    if args.func == bench_model:
+        for name in ('shells', 'triangles', 'colors', 'runs', 'depth',
+                     'batches'):
+            if getattr(args, name) < 1:
+                parser.error("--{} must be at least 1".format(name))
+    sys.exit(args.func(args))
@@ -31,16 +31,23 @@
 # 2014
 
 import logging
+import mmap
 import sys
 
+from array import array
+from itertools import chain, islice
 from math import isinf, isnan
 from decimal import Decimal
 from struct import pack, unpack
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 version = '.'.join(map(str, sys.version_info[:2]))
 
 if version >= '3.0':
-    from io import BytesIO
     basestring = (str, bytes)
     unicode = str
     bytes = bytes
@@ -52,7 +59,6 @@ if version >= '3.0':
     dict_valuesiterator = type(d.values())
     dict_itemsiterator = type(d.items())
 else:
-    from cStringIO import StringIO as BytesIO
     basestring = basestring
     unicode = unicode
     b = bytes = str
@@ -93,6 +99,8 @@ OBJECT_S = b('o')
 ARRAY_L = b('A')
 OBJECT_L = b('O')
 FF = b(chr(255))
+DELTA = b('X')
+VARINT = b('V')
 
 BOS_A = object()
 BOS_O = object()
@@ -103,11 +111,84 @@ STRINGS = set([STRING_S, STRING_L, HIDEF_S, HIDEF_L])
 SHORT_OBJ = set([STRING_S, HIDEF_S, ARRAY_S, OBJECT_S])
 LARGE_OBJ = set([STRING_L, HIDEF_L, ARRAY_L, OBJECT_L])
 STREAMS = set([ARRAY_S, OBJECT_S])
+ARRAYS = set([ARRAY_S, ARRAY_L])
 OBJECT_KEYS = set([STRING_S, STRING_L])
 FORBIDDEN = set([NOOP, EOS])
 
 CHARS = dict((i, b(chr(i))) for i in range(256))
 
+INTEGERS = set([int, long])
+FLOATS = set([float])
+# elements packed per struct call and bytes buffered per write when streaming
+PACK_CHUNK = 1 << 16
+WRITE_BUFFER = 1 << 16
+TYPE_SIZES = {INT8: 1, INT16: 2, INT32: 4, INT64: 8, FLOAT: 4, DOUBLE: 8}
+# integer arrays shorter than this are never delta coded
+DELTA_MIN = 16
+
+
+def _typecode(size, candidates):
+    """First array.array typecode with the given item size"""
+    for code in candidates:
+        try:
+            if array(code).itemsize == size:
+                return code
+        except ValueError:
+            pass
+    return None
+
+TYPECODES = {INT8: 'b', INT16: _typecode(2, 'hi'), INT32: _typecode(4, 'il'),
+             INT64: _typecode(8, 'qlL'), FLOAT: 'f', DOUBLE: 'd'}
+TYPE_FORMATS = {INT8: 'b', INT16: 'h', INT32: 'i', INT64: 'q',
+                FLOAT: 'f', DOUBLE: 'd'}
+
+
+def varint_bytes(values, sizes):
+    """LEB128 encoding of non-negative integers, given the number of bytes
+    each takes"""
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        ends = numpy.cumsum(sizes)
+        starts = ends - sizes
+        res = numpy.empty(int(ends[-1]) if len(ends) else 0, dtype='u1')
+        for k in xrange(int(sizes.max()) if len(sizes) else 0):
+            sel = sizes > k
+            more = (sizes[sel] > k + 1) << 7
+            res[starts[sel] + k] = (values[sel] >> 7 * k) & 0x7f | more
+        return res.tobytes()
+    res = bytearray()
+    for value in values:
+        while value > 0x7f:
+            res.append(value & 0x7f | 0x80)
+            value >>= 7
+        res.append(value)
+    return bytes(res)
+
+
+def varint_values(data, length, use_numpy):
+    """Decodes length LEB128 encoded non-negative integers"""
+    if use_numpy:
+        raw = numpy.frombuffer(data, dtype='u1').astype('i8')
+        last = raw < 0x80
+        if int(last.sum()) != length or (length and not last[-1]):
+            raise DecodeError('varints do not match the array length')
+        if not length:
+            return raw
+        starts = numpy.flatnonzero(numpy.concatenate(([True], last[:-1])))
+        place = numpy.arange(len(raw)) - numpy.repeat(
+            starts, numpy.diff(numpy.append(starts, len(raw))))
+        return numpy.add.reduceat((raw & 0x7f) << 7 * place, starts)
+    res = []
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            res.append(value)
+            value = shift = 0
+    if len(res) != length or shift:
+        raise DecodeError('varints do not match the array length')
+    return res
+
 
 class DecodeError(ValueError):
     """UBJSON data decoding error."""
@@ -126,12 +207,8 @@ class EncodeError(TypeError):
 
 
 class TysonDecoder(object):
-    # TODO: adjust the decoder to understand the tyson format, now it does
-    # DRAFT 8 ubjson decoding
-
-
-    """Decoder of UBJSON data to Python object following Draft 8 specification
-    and using next data mapping:
+    """Decoder of TySON data to Python object following UBJSON Draft 8
+    specification and using next data mapping:
 
     +--------+----------------------------+----------------------------+-------+
     | Marker | UBJSON type                | Python type                | Notes |
@@ -170,6 +247,9 @@ class TysonDecoder(object):
     +--------+----------------------------+----------------------------+-------+
     | ``A``  | array - 5 bytes            | list                       |       |
     +--------+----------------------------+----------------------------+-------+
+    | ``a``, | typed array                | numpy.ndarray,             | \(4)  |
+    | ``A``  |                            | array.array or list        |       |
+    +--------+----------------------------+----------------------------+-------+
     | ``o``  | object - 2 bytes           | dict                       |       |
     +--------+----------------------------+----------------------------+-------+
     | ``o``  | object - unsized           | generator                  | \(3)  |
@@ -189,19 +269,42 @@ class TysonDecoder(object):
     (3)
         Unsized objects are represented as list of 2-element tuple with object
         key and value.
+
+    (4)
+        TySON arrays carry a type marker after ``a``/``A``: ``M`` for mixed
+        items, or a number marker for a packed array of that type.  Packed
+        arrays are returned according to the `arrays` argument: ``'numpy'``
+        (the default when NumPy is installed) gives a big-endian
+        :class:`numpy.ndarray`, ``'array'`` a native :class:`array.array` and
+        ``'list'`` a list.  When the source is a buffer (bytes, bytearray or
+        mmap) rather than a stream, numpy arrays are read-only views over it
+        and no element data is copied.  The ``X`` marker is a delta coded
+        integer array, returned as 32-bit integers, see
+        :class:`TysonEncoder`.
     """
 
     dispatch = {}
 
-    def __init__(self, source, allow_noop=False):
+    def __init__(self, source, allow_noop=False, arrays=None):
         if isinstance(source, unicode):
             source = source.encode('utf-8')
-        if isinstance(source, bytes):
-            source = BytesIO(source)
-        self.read = source.read
+        if hasattr(source, 'read') and not isinstance(source, mmap.mmap):
+            self.buffer = None
+            self.read = source.read
+        else:
+            self.buffer = source
+            self.pos = 0
+            self.read = self.read_buffer
         self.allow_noop = allow_noop
+        self.arrays = arrays or (numpy is not None and 'numpy' or 'array')
         self.dispatch = self.dispatch.copy()
 
+    def read_buffer(self, size):
+        start = self.pos
+        self.pos = start + size
+        chunk = self.buffer[start:self.pos]
+        return chunk if type(chunk) is bytes else bytes(chunk)
+
     def __iter__(self):
         return self
 
@@ -213,7 +316,7 @@ class TysonDecoder(object):
             if tag == INT8:
                 # Trivial operations for trivial cases saves a lot of time
                 value = ord(self.read(1))
-                if value > 128:
+                if value > 127:
                     value -= 256
                     #value, = unpack('>b', self.read(1))
             elif tag == INT16:
@@ -229,6 +332,19 @@ class TysonDecoder(object):
             else:
                 raise MarkerError('tag %r not in NUMBERS %r' % (tag, NUMBERS))
             return tag, None, value
+        elif tag in ARRAYS:
+            # arrays are followed by their type marker, or FF when unsized
+            array_type = self.read(1)
+            if tag == ARRAY_S and array_type == FF:
+                return tag, 255, None
+            if array_type not in (MIXED, DELTA) and \
+                    array_type not in TYPE_SIZES:
+                raise MarkerError('invalid array type %r' % array_type)
+            if tag == ARRAY_S:
+                length = ord(self.read(1))
+            else:
+                length, = unpack('>I', self.read(4))
+            return tag, length, array_type
         elif tag in SHORT_OBJ:
             length = ord(self.read(1))
             if tag in STRINGS:
@@ -297,6 +413,10 @@ class TysonDecoder(object):
     def decode_array(self, tag, length, value):
         if tag == ARRAY_S and length == 255:
             return self.decode_array_stream(tag, length, value)
+        if value == DELTA:
+            return self.decode_delta_array(length)
+        if value != MIXED:
+            return self.decode_typed_array(length, value)
         res = [None] * length
         next_tlv = self.next_tlv
         dispatch = self.dispatch
@@ -314,6 +434,68 @@ class TysonDecoder(object):
     dispatch[ARRAY_S] = decode_array
     dispatch[ARRAY_L] = decode_array
 
+    def decode_typed_array(self, length, array_type):
+        size = length * TYPE_SIZES[array_type]
+        fmt = TYPE_FORMATS[array_type]
+        if self.arrays == 'numpy' and self.buffer is not None:
+            # a view straight over the source buffer
+            offset = self.pos
+            self.pos += size
+            if self.pos > len(self.buffer):
+                raise EarlyEndOfStreamError('typed array overruns the data')
+            return numpy.frombuffer(self.buffer, '>' + fmt, length, offset)
+        data = self.read(size)
+        if len(data) < size:
+            raise EarlyEndOfStreamError('typed array overruns the data')
+        if self.arrays == 'numpy':
+            return numpy.frombuffer(data, '>' + fmt, length)
+        elif self.arrays == 'array':
+            res = array(TYPECODES[array_type])
+            (getattr(res, 'frombytes', None) or res.fromstring)(data)
+            if sys.byteorder == 'little':
+                res.byteswap()
+            return res
+        return list(unpack('>%d%s' % (length, fmt), data))
+
+    def delta_header(self, length):
+        """Reads the coding of a delta coded array, returning it with the
+        size of the coded differences"""
+        coding = self.read(1)
+        if coding == VARINT:
+            size, = unpack('>I', self.read(4))
+        elif coding in (INT8, INT16):
+            size = length * TYPE_SIZES[coding]
+        else:
+            raise MarkerError('invalid delta coding %r' % coding)
+        return coding, size
+
+    def decode_delta_array(self, length):
+        coding, size = self.delta_header(length)
+        data = self.read(size)
+        if len(data) < size:
+            raise EarlyEndOfStreamError('typed array overruns the data')
+        use_numpy = self.arrays == 'numpy'
+        if coding == VARINT:
+            deltas = varint_values(data, length, use_numpy)
+            if use_numpy:
+                deltas = (deltas >> 1) ^ -(deltas & 1)
+            else:
+                deltas = [(x >> 1) ^ -(x & 1) for x in deltas]
+        elif use_numpy:
+            deltas = numpy.frombuffer(data, '>' + TYPE_FORMATS[coding])
+        else:
+            deltas = unpack('>%d%s' % (length, TYPE_FORMATS[coding]), data)
+        if use_numpy:
+            return numpy.cumsum(deltas, dtype='i8').astype('i4')
+        res = []
+        value = 0
+        for delta in deltas:
+            value += delta
+            res.append(value)
+        if self.arrays == 'array':
+            return array(TYPECODES[INT32], res)
+        return res
+
     def decode_object(self, tag, length, value):
         if tag == OBJECT_S and length == 255:
             return self.decode_object_stream(tag, length, value)
@@ -394,6 +576,79 @@ class TysonDecoder(object):
                         key = None
         return object_stream()
 
+    def skip(self, size):
+        if self.buffer is not None:
+            self.pos += size
+        else:
+            self.read(size)
+
+    def skip_next(self):
+        """Advances past the next value without decoding it.  Packed arrays
+        are stepped over in one move."""
+        self.skip_value(*self.next_tlv())
+
+    def skip_value(self, tag, length, value):
+        if tag in ARRAYS:
+            if tag == ARRAY_S and length == 255:
+                self.skip_stream()
+            elif value == MIXED:
+                for _ in range(length):
+                    self.skip_next()
+            elif value == DELTA:
+                self.skip(self.delta_header(length)[1])
+            else:
+                self.skip(length * TYPE_SIZES[value])
+        elif tag in (OBJECT_S, OBJECT_L):
+            if tag == OBJECT_S and length == 255:
+                self.skip_stream()
+            else:
+                for _ in range(length * 2):
+                    self.skip_next()
+        # scalars and strings were consumed by next_tlv
+
+    def skip_stream(self):
+        """Skips the rest of an unsized container, keys included"""
+        while True:
+            tlv = self.next_tlv()
+            if tlv[0] == EOS:
+                break
+            self.skip_value(*tlv)
+
+    def iter_entries(self):
+        """Yields the key and value offset of each entry of the object that
+        starts here, skipping the values.  Needs a buffer source."""
+        tag, length, value = self.next_tlv()
+        if tag not in (OBJECT_S, OBJECT_L):
+            raise MarkerError('object expected, got %r' % tag)
+        unsized = tag == OBJECT_S and length == 255
+        count = 0
+        while unsized or count < length:
+            tag, klength, key = self.next_tlv()
+            if tag == EOS and unsized:
+                break
+            if tag not in OBJECT_KEYS:
+                raise MarkerError('key should be string, got %r' % (tag))
+            yield key.decode('utf-8'), self.pos
+            self.skip_next()
+            count += 1
+
+    def iter_items(self):
+        """Yields the offset of each item of the mixed array that starts
+        here, skipping the items.  Needs a buffer source."""
+        tag, length, value = self.next_tlv()
+        if tag not in ARRAYS or value not in (MIXED, None):
+            raise MarkerError('mixed array expected, got %r' % tag)
+        unsized = value is None
+        count = 0
+        while unsized or count < length:
+            pos = self.pos
+            if unsized and self.next_tlv()[0] == EOS:
+                break
+            self.pos = pos
+            yield pos
+            self.skip_next()
+            count += 1
+
 
 class TysonEncoder(object):
     """Encoder of Python objects into UBJSON data following Draft 8
@@ -472,44 +727,96 @@ class TysonEncoder(object):
          This works well when the numbers in the array are mostly in the same
          range
 
+         Float arrays are packed the same way, as ``float`` when every value
+         fits single precision and as ``double`` otherwise.  Arrays holding
+         an infinity or NaN stay MIXED so those values still become null.
+
+         :class:`array.array` and 1-d :class:`numpy.ndarray` objects are
+         encoded the same way, the latter straight from its buffer.
+
+         With `delta`, integer arrays whose values need int16 or int32 may
+         instead be delta coded, marked ``X``, when that is smaller: the
+         differences between consecutive values, the first taken from zero,
+         are packed as ``int8`` or ``int16`` when they all fit, marked ``B``
+         or ``i``, or else zigzag encoded as LEB128 varints, marked ``V``
+         and preceded by their byte count as an unsigned 32-bit integer.
+
     """
 
     dispatch = {}
 
-    def __init__(self, default=None):
+    def __init__(self, default=None, float64=False, delta=False):
         self._default = default or self.default
+        self.float64 = float64
+        self.delta = delta
 
     def default(self, obj):
         raise EncodeError('unable to encode %r' % obj)
 
     @classmethod
-    def encode(cls, data, output=None):
+    def encode(cls, data, output=None, float64=False, delta=False):
         """Encodes Python object to Universal Binary JSON data.
 
         :param data: Python object.
         :param output: `.write([data])`-able object. If omitted result would be
                        returned instead of written into.
+        :param float64: Pack float arrays in double instead of single
+                        precision.
+        :param delta: Delta code integer arrays where that is smaller.
 
         :return: Encoded Python object. See mapping table below.
                  If `output` param is specified, all data would be written into it
                  by chunks and None will be returned.
         """
-        res = TysonEncoder(None).encode_next(data)
+        encoder = TysonEncoder(None, float64, delta)
 
         if output:
-            output.write(res)
+            encoder.write(data, output)
         else:
-            return res
+            return encoder.encode_next(data)
+
+    def write(self, obj, output, buffer_size=WRITE_BUFFER):
+        """Streams the encoding of obj into output through one reusable
+        buffer.  Sized containers know their length before their first item
+        is encoded, so nothing written is ever patched afterwards."""
+        buf = bytearray()
+        for chunk in self.iterencode(obj):
+            if len(chunk) >= buffer_size:
+                # large chunks skip the buffer entirely
+                if buf:
+                    output.write(buf)
+                    del buf[:]
+                output.write(chunk)
+                continue
+            buf += chunk
+            if len(buf) >= buffer_size:
+                output.write(buf)
+                del buf[:]
+        if buf:
+            output.write(buf)
 
     def encode_next(self, obj):
+        return bytes().join(self.iterencode(obj))
+
+    def iterencode(self, obj):
+        """Yields the encoding of obj chunk by chunk.  Containers yield the
+        iterencode of each item, which is expanded here instead of being
+        joined level by level."""
         tobj = type(obj)
-        if tobj in self.dispatch:
-            res = self.dispatch[tobj](self, obj)
-        else:
-            return self.encode_next(self._default(obj))
+        if tobj not in self.dispatch:
+            for chunk in self.iterencode(self._default(obj)):
+                yield chunk
+            return
+        res = self.dispatch[tobj](self, obj)
         if isinstance(res, bytes):
-            return res
-        return bytes().join(res)
+            yield res
+            return
+        for part in res:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                for chunk in part:
+                    yield chunk
 
     def encode_noop(self, obj):
         return NOOP
@@ -564,7 +871,7 @@ class TysonEncoder(object):
         if length < 255:
             return STRING_S + CHARS[length] + obj
         else:
-            return STRING_L + INT32 + pack('>i', length) + obj
+            return STRING_L + pack('>I', length) + obj
 
     def encode_bytes(self, obj):
         try:
@@ -588,49 +895,177 @@ class TysonEncoder(object):
             return HIDEF_L + pack('>i', length) + obj
     dispatch[Decimal] = encode_decimal
 
+    def int_array_type(self, low, high):
+        """Smallest integer marker able to hold every value in [low, high],
+        chosen by magnitude, or MIXED if none can"""
+        magnitude = max(high, -low)
+        if magnitude <= 2 ** 7 - 1:
+            return INT8
+        elif magnitude <= 2 ** 15 - 1:
+            return INT16
+        elif magnitude <= 2 ** 31 - 1:
+            return INT32
+        elif magnitude <= 2 ** 63 - 1:
+            return INT64
+        return MIXED
+
+    def float_array_type(self, low, high):
+        """FLOAT when every non-zero magnitude in [low, high] is in the
+        single precision range, as for single floats, DOUBLE otherwise"""
+        if self.float64 or not 1.18e-38 <= low <= high <= 3.4e38:
+            return DOUBLE
+        return FLOAT
+
+    def sequence_type(self, obj):
+        """Marker to pack the whole sequence with, or MIXED"""
+        if isinstance(obj, array):
+            # the typecode tells what every element is
+            types = obj.typecode in 'fd' and FLOATS or set([int])
+        else:
+            types = set(map(type, obj))
+        if types <= INTEGERS:
+            return self.int_array_type(min(obj), max(obj))
+        if types == FLOATS:
+            total = sum(obj)
+            if isinf(total) or isnan(total):
+                # infinities and NaN must still become null
+                return MIXED
+            # all zeros pack as single precision
+            magnitudes = [x for x in map(abs, obj) if x] or [1.0]
+            return self.float_array_type(min(magnitudes), max(magnitudes))
+        return MIXED
+
+    def array_header(self, length, array_type):
+        if length < 255:
+            return ARRAY_S + array_type + CHARS[length]
+        else:
+            return ARRAY_L + array_type + pack('>I', length)
+
+    def pack_sequence(self, obj, array_type):
+        fmt = '>%d' + TYPE_FORMATS[array_type]
+        items = iter(obj)
+        while True:
+            part = tuple(islice(items, PACK_CHUNK))
+            if not part:
+                break
+            yield pack(fmt % len(part), *part)
+
+    def pack_array(self, obj, array_type):
+        """Pack an array.array from its buffer, converted to the item type
+        of array_type and swapped to big endian where needed"""
+        code = TYPECODES[array_type]
+        if code is None:
+            return self.pack_sequence(obj, array_type)
+        packed = array(code, obj)
+        if sys.byteorder == 'little':
+            packed.byteswap()
+        return [(getattr(packed, 'tobytes', None) or packed.tostring)()]
+
+    def delta_candidate(self, array_type, length):
+        """Whether an integer array might be smaller delta coded"""
+        return (self.delta and array_type in (INT16, INT32) and
+                length >= DELTA_MIN)
+
+    def encode_delta(self, obj, array_type):
+        """The chunks of an integer array delta coded, or None when that
+        is no smaller than packing it as array_type"""
+        length = len(obj)
+        if numpy is not None:
+            values = numpy.asarray(obj, dtype='i8')
+            deltas = numpy.diff(numpy.concatenate(([0], values)))
+            low, high = int(deltas.min()), int(deltas.max())
+        else:
+            deltas = [x - y for x, y in zip(obj, chain([0], obj))]
+            low, high = min(deltas), max(deltas)
+        delta_type = self.int_array_type(low, high)
+        if delta_type not in (INT8, INT16, INT32):
+            return None
+        if numpy is not None:
+            zigzag = (deltas << 1) ^ (deltas >> 63)
+            sizes = numpy.ones(length, dtype='i8')
+            for k in xrange(1, 5):
+                sizes += zigzag >> 7 * k > 0
+            varint_size = int(sizes.sum())
+        else:
+            zigzag = [(x << 1) ^ (x >> 63) for x in deltas]
+            sizes = [(x.bit_length() + 6) // 7 or 1 for x in zigzag]
+            varint_size = sum(sizes)
+        codings = [(varint_size + 5, VARINT)]
+        if delta_type != INT32:
+            codings.append((length * TYPE_SIZES[delta_type] + 1, delta_type))
+        size, coding = min(codings)
+        if size >= length * TYPE_SIZES[array_type]:
+            return None
+        header = self.array_header(length, DELTA) + coding
+        if coding == VARINT:
+            return [header + pack('>I', varint_size),
+                    varint_bytes(zigzag, sizes)]
+        if numpy is not None:
+            return [header, self.pack_ndarray(deltas, coding)]
+        return [header, self.pack_sequence(deltas, coding)]
+
     def encode_sequence(self, obj):
         length = len(obj)
 
+        # the sequence is type checked exactly once, then packed in bulk
         array_type = MIXED
-        try:
-            encoded_item = self.encode_next(max([abs(item) for item in obj]))
-            if encoded_item.startswith(INT8):
-                array_type = INT8
-            elif encoded_item.startswith(INT16):
-                array_type = INT16
-            elif encoded_item.startswith(INT32):
-                array_type = INT32
-            elif encoded_item.startswith(INT64):
-                array_type = INT64
-        except:
-            # not number elements
-            array_type = MIXED
-
-        if array_type != MIXED:
-            try:
-                if length < 255:
-                    return_value = ARRAY_S + array_type + CHARS[length]
-                else:
-                    return_value = ARRAY_L + array_type + pack('>I', length)
-                for item in obj:
-                    return_value += self.encode_int(item, array_type)
-                yield return_value
-            except:
-                # the maximum was an integer, but the array is not homogeneous
-                array_type = MIXED
-
-        if array_type == MIXED:
-            if length < 255:
-                yield ARRAY_S + array_type + CHARS[length]
-            else:
-                yield ARRAY_L + array_type + pack('>I', length)
+        if length:
+            array_type = self.sequence_type(obj)
+
+        if self.delta_candidate(array_type, length) and \
+                not isinstance(obj, (set, frozenset)):
+            coded = self.encode_delta(obj, array_type)
+            if coded:
+                for chunk in coded:
+                    yield chunk
+                return
+
+        yield self.array_header(length, array_type)
+        if array_type != MIXED and isinstance(obj, array):
+            yield self.pack_array(obj, array_type)
+        elif array_type != MIXED:
+            yield self.pack_sequence(obj, array_type)
+        else:
             for item in obj:
-                yield self.encode_next(item)
+                yield self.iterencode(item)
 
     dispatch[tuple] = encode_sequence
     dispatch[list] = encode_sequence
     dispatch[set] = encode_sequence
     dispatch[frozenset] = encode_sequence
+    dispatch[array] = encode_sequence
+
+    def ndarray_type(self, obj):
+        """Marker to pack a non-empty 1-d numpy array with, or MIXED"""
+        if obj.dtype.kind in 'iu':
+            return self.int_array_type(int(obj.min()), int(obj.max()))
+        if obj.dtype.kind == 'f' and numpy.isfinite(obj).all():
+            magnitudes = numpy.abs(obj[obj != 0])
+            if not magnitudes.size:
+                return self.float_array_type(1.0, 1.0)
+            return self.float_array_type(
+                float(magnitudes.min()), float(magnitudes.max()))
+        return MIXED
+
+    def encode_ndarray(self, obj):
+        array_type = MIXED
+        if obj.ndim == 1 and obj.size:
+            array_type = self.ndarray_type(obj)
+        if array_type == MIXED:
+            return self.encode_sequence(obj.tolist())
+        if self.delta_candidate(array_type, obj.size):
+            coded = self.encode_delta(obj, array_type)
+            if coded:
+                return coded
+        return [self.array_header(obj.size, array_type),
+                self.pack_ndarray(obj, array_type)]
+
+    def pack_ndarray(self, obj, array_type):
+        dtype = '>' + TYPE_FORMATS[array_type]
+        for start in xrange(0, obj.size, PACK_CHUNK):
+            yield obj[start:start + PACK_CHUNK].astype(dtype).tobytes()
+    if numpy is not None:
+        dispatch[numpy.ndarray] = encode_ndarray
 
     def encode_dict(self, obj):
         length = len(obj)
@@ -645,13 +1080,13 @@ class TysonEncoder(object):
                 yield self.encode_bytes(key)
             else:
                 raise EncodeError('invalid object key %r' % key)
-            yield self.encode_next(value)
+            yield self.iterencode(value)
     dispatch[dict] = encode_dict
 
     def encode_generator(self, obj):
         yield ARRAY_S + FF
         for item in obj:
-            yield self.encode_next(item)
+            yield self.iterencode(item)
         yield EOS
     dispatch[xrange] = encode_generator
     dispatch[type((i for i in ()))] = encode_generator
@@ -667,6 +1102,91 @@ class TysonEncoder(object):
                 yield self.encode_bytes(key)
             else:
                 raise EncodeError('invalid object key %r' % key)
-            yield self.encode_next(value)
+            yield self.iterencode(value)
         yield EOS
     dispatch[dict_itemsiterator] = encode_dictitems
+
+
+class TysonReader(object):
+    """Lazy reader for a TySON file whose top level is an object.  The file
+    is memory mapped and only the values asked for are decoded; everything
+    else is skipped over by offset.
+
+    Items of an array member can be looked up by one of their fields, e.g.
+    ``reader.find('shells', 'id', '12')``.  The lookup table is built on
+    first use by decoding just that field of each item.
+    """
+
+    def __init__(self, path, arrays=None):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.arrays = arrays
+        self._members = None
+        self._indexes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the file.  NumPy arrays decoded from it are views over the
+        mapping and keep it alive, so it is only unmapped once the last of
+        them is gone"""
+        self.mmap = None
+        self.file.close()
+
+    def decoder(self, offset=0):
+        """A decoder positioned at offset"""
+        decoder = TysonDecoder(self.mmap, arrays=self.arrays)
+        decoder.pos = offset
+        return decoder
+
+    def members(self):
+        """Offsets of the top level values by key"""
+        if self._members is None:
+            self._members = dict(self.decoder().iter_entries())
+        return self._members
+
+    def __contains__(self, key):
+        return key in self.members()
+
+    def __getitem__(self, key):
+        return self.decoder(self.members()[key]).decode_next()
+
+    def extent(self, offset):
+        """Length in bytes of the value at offset"""
+        decoder = self.decoder(offset)
+        decoder.skip_next()
+        return decoder.pos - offset
+
+    def item_offsets(self, key):
+        """Offsets of the items of the array member key"""
+        return list(self.decoder(self.members()[key]).iter_items())
+
+    def index(self, key, field):
+        """Offsets of the items of the array member key by their field"""
+        if (key, field) not in self._indexes:
+            index = {}
+            for offset in self.item_offsets(key):
+                for name, pos in self.decoder(offset).iter_entries():
+                    if name == field:
+                        index[self.decoder(pos).decode_next()] = offset
+                        break
+            self._indexes[(key, field)] = index
+        return self._indexes[(key, field)]
+
+    def find(self, key, field, value):
+        """Decode the item of the array member key whose field is value"""
+        return self.decoder(self.index(key, field)[value]).decode_next()
+
+
+class BatchReader(TysonReader):
+    """Random access to the shells of a batch file"""
+
+    def shell_ids(self):
+        return list(self.index('shells', 'id'))
+
+    def shell(self, sid):
+        return self.find('shells', 'id', sid)
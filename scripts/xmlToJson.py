@@ -7,19 +7,35 @@
 # https://github.com/ghemingway/cad.js/blob/master/scripts/xmlToJson.js
 
 import argparse
+from array import array
+import cPickle as pickle
+from collections import deque
 from datetime import datetime
+import errno
+import hashlib
+import heapq
 import json
 import math
-from multiprocessing import cpu_count, Process, Queue
+import mmap
+from multiprocessing import cpu_count, Pool
+from multiprocessing.queues import SimpleQueue
 from operator import itemgetter
 import os
 from os.path import join
+import Queue as queue
 import re
+import shutil
 import sys
-import time
+import tempfile
 import xml.etree.cElementTree as ET
+import zlib
 
-from tyson import TysonEncoder
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tyson import TysonEncoder, TysonReader
 
 import logging
 logging.basicConfig(
@@ -29,8 +45,27 @@ LOG = logging.getLogger(__name__)
 # defaults and constants
 DEFAULT_COLOR = "7d7d7d"
 IDENTITY_TRANSFORM = "1 0 0 0 0 1 0 0 0 0 1 0 0 0 0 1"
-SHELL_REGEX = re.compile("shell_(.*?).json")
+SHELL_REGEX = re.compile(r"shell_(.*?)\.json$")
+LOD_REGEX = re.compile(r"\.lod\d+\.json$")
+FACET_REGEX = re.compile(br"<f[\s/>]")
+BYTES_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(?:([kmg])i?)?b?\s*$", re.I)
+BYTE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
 ALT_ENCODINGS = ['latin-1']
+READ_CHUNK = 1 << 16
+# seconds between checks on the workers while waiting for a job to finish
+POLL_SECS = 1
+# compressed copies written beside each output, by encoding: the extension
+# and the zlib window bits giving its container
+SIDECARS = {'gzip': ('.gz', 16 + zlib.MAX_WBITS),
+            'deflate': ('.zz', zlib.MAX_WBITS)}
+CACHE_FILE = ".xmlToJson.cache"
+# settings that change the translated output, and so invalidate the cache
+CACHE_CONFIG = ('indexPoints', 'indexNormals', 'compressColors',
+                'roundPrecision', 'facetColors', 'weldVertices',
+                'optimizeCache', 'vertexCache', 'quantizeBits', 'octNormals',
+                'lodLevels', 'lodCells', 'sidecars', 'sidecarLevel')
+# shared value table order, normals first as the converter has always emitted
+INDEXING = (('indexNormals', 'normals'), ('indexPoints', 'points'))
 
 #------------------------------------------------------------------------------
 
@@ -38,7 +73,27 @@ CONFIG = {
     'indexPoints': True,
     'indexNormals': True,
     'compressColors': True,
-    'roundPrecision': 2
+    'roundPrecision': 2,
+    'streamShells': True,
+    'facetColors': False,
+    'weldVertices': False,
+    'optimizeCache': False,
+    # entries of the FIFO vertex cache that welded shells are ordered for
+    'vertexCache': 16,
+    # bits per coordinate of points quantized in their bounding box, 0 off
+    'quantizeBits': 0,
+    # bits per coordinate of octahedral normals, 8 or 16, 0 off
+    'octNormals': 0,
+    # delta code the integer arrays of TySON batches where that is smaller
+    'deltaArrays': False,
+    'splitFacets': 1000000,
+    'splitBytes': 256 << 20,
+    # encodings of the compressed copies of every output, and their level
+    'sidecars': [],
+    'sidecarLevel': 9,
+    'lodLevels': 0,
+    # grid cells along the longest side of a shell, per level of detail
+    'lodCells': [64, 16, 4]
 }
 
 
@@ -62,6 +117,148 @@ def parse_xml(path):
     return None
 
 
+def stream_xml(path, target, span=None):
+    """Feed an XML file, or a span of a shell file, through a parser target,
+    falling back to alternate encodings.  Returns the target's close()
+    result, or None on failure"""
+    encodings = [None] + ALT_ENCODINGS[:]
+    for e in encodings:
+        p = ET.XMLParser(target=target(), encoding=e)
+        try:
+            with open(path, 'rb') as f:
+                chunks = span and span_chunks(f, span) or file_chunks(f)
+                for chunk in chunks:
+                    p.feed(chunk)
+            return p.close()
+        except ET.ParseError:
+            pass
+    return None
+
+
+def file_chunks(f, size=None):
+    """Read a file chunk by chunk, up to size bytes or to its end"""
+    while size is None or size > 0:
+        chunk = f.read(READ_CHUNK if size is None else min(size, READ_CHUNK))
+        if not chunk:
+            return
+        if size is not None:
+            size -= len(chunk)
+        yield chunk
+
+
+def span_chunks(f, span):
+    """The document made of a span of a shell file: the head of the file,
+    the opening tag of the facets group the span starts in, the span and
+    the tags closing the document"""
+    head, start, end, opening, closing = span
+    for chunk in file_chunks(f, head):
+        yield chunk
+    yield opening
+    f.seek(start)
+    for chunk in file_chunks(f, end - start):
+        yield chunk
+    yield closing
+
+
+def facet_spans(path, parts):
+    """Cut the facets of a shell file into up to parts spans of about equal
+    size, each starting at a facet, by searching the bytes around each cut
+    only.  The head of the file, up to the first facets group, is shared by
+    all.  None when the file does not hold its vertices before its
+    facets."""
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+    try:
+        head = data.find(b'<facets')
+        if head < 0 or data.find(b'<verts', head) >= 0:
+            return None
+        cuts = [head]
+        for i in xrange(1, parts):
+            target = head + (len(data) - head) * i // parts
+            match = FACET_REGEX.search(data, max(target, cuts[-1] + 1))
+            if not match:
+                break
+            cuts.append(match.start())
+        cuts.append(len(data))
+        last = data.rfind(b'</facets>')
+        closing = data[last:]
+        spans = []
+        for start, end in zip(cuts, cuts[1:]):
+            opening = b''
+            if start > head:
+                group = data.rfind(b'<facets', head, start)
+                opening = data[group:data.find(b'>', group) + 1]
+            spans.append((head, start, end, opening,
+                          closing if end < len(data) else b''))
+        return spans
+    finally:
+        data.close()
+
+
+def sidecar_extensions():
+    """Extensions of the configured compressed copies of an output"""
+    return [SIDECARS[x][0] for x in CONFIG['sidecars']]
+
+
+class OutputFile(object):
+    """A file open for writing that streams what is written through each
+    configured encoding into a sibling file, e.g. shell_sh0.json.gz.
+    Siblings of encodings no longer configured are removed, so none are
+    left stale.  Writes must be sequential."""
+
+    def __init__(self, path, mode="w"):
+        self.file = open(path, mode)
+        self.sidecars = []
+        for encoding, (extension, wbits) in sorted(SIDECARS.items()):
+            sidecar = path + extension
+            if encoding in CONFIG['sidecars']:
+                z = zlib.compressobj(CONFIG['sidecarLevel'], zlib.DEFLATED,
+                                     wbits)
+                self.sidecars.append((open(sidecar, "wb"), z))
+            elif os.path.isfile(sidecar):
+                os.remove(sidecar)
+        self.pending = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+        if kind is not None:
+            # drop partial copies with the failed output
+            for f, _ in self.sidecars:
+                os.remove(f.name)
+
+    def write(self, data):
+        self.file.write(data)
+        if self.sidecars:
+            self.pending += data
+            if len(self.pending) >= READ_CHUNK:
+                self.compress()
+
+    def compress(self):
+        """Feed the buffered output to the encoders"""
+        data = bytes(self.pending)
+        for f, z in self.sidecars:
+            f.write(z.compress(data))
+        del self.pending[:]
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        self.compress()
+        for f, z in self.sidecars:
+            f.write(z.flush())
+            f.close()
+
+
 #------------------------------------------------------------------------------
 
 def translate_index(doc, use_tyson):
@@ -135,6 +332,56 @@ def translate_annotation(annotation):
     return data
 
 
+def xform_matrix(xform):
+    """The column-major 4x4 matrix of a translated xform"""
+    if xform == "I":
+        return [float(x) for x in IDENTITY_TRANSFORM.split(" ")]
+    return xform
+
+
+def compose(a, b):
+    """Product of two column-major 4x4 matrices"""
+    return [sum(a[k * 4 + r] * b[c * 4 + k] for k in xrange(4))
+            for c in xrange(4) for r in xrange(4)]
+
+
+def transform_bbox(m, bbox):
+    """Axis-aligned bounds of a bounding box under a transform"""
+    corners = [(x, y, z) for x in (bbox[0], bbox[3])
+               for y in (bbox[1], bbox[4]) for z in (bbox[2], bbox[5])]
+    points = [[m[r] * x + m[4 + r] * y + m[8 + r] * z + m[12 + r]
+               for r in xrange(3)] for x, y, z in corners]
+    return ([min(p[i] for p in points) for i in xrange(3)] +
+            [max(p[i] for p in points) for i in xrange(3)])
+
+
+def union_bbox(bboxes):
+    """Bounding box of several bounding boxes"""
+    return ([min(b[i] for b in bboxes) for i in xrange(3)] +
+            [max(b[i] for b in bboxes) for i in xrange(3, 6)])
+
+
+def world_bboxes(data):
+    """World-space bounding box of each shell in a translated index, over
+    every placement of it in the shape hierarchy"""
+    shapes = dict((x['id'], x) for x in data['shapes'])
+    local = dict((x['id'], x['bbox']) for x in data['shells'] if 'bbox' in x)
+    refs = set(c['ref'] for x in data['shapes'] for c in x['children'])
+    identity = xform_matrix("I")
+    placed = {}
+    stack = [(x, identity) for x in shapes if x not in refs]
+    while stack:
+        sid, m = stack.pop()
+        for shell in shapes[sid]['shells']:
+            if shell in local:
+                bbox = transform_bbox(m, local[shell])
+                placed.setdefault(shell, []).append(bbox)
+        for child in shapes[sid]['children']:
+            xform = xform_matrix(child['xform'])
+            stack.append((child['ref'], compose(m, xform)))
+    return dict((k, union_bbox(v)) for k, v in placed.items())
+
+
 #------------------------------------------------------------------------------
 
 def make_index(data, ikey, ranger=None):
@@ -156,8 +403,54 @@ indexPoints = lambda d: make_index(d, 'points')
 indexNormals = lambda d: make_index(d, 'normals')
 
 
+def round_floats(vals, precision):
+    """Vectorized round_float, rounding halves away from zero like round"""
+    if not precision:
+        return vals
+    scaled = vals * math.pow(10, precision)
+    rounded = np.trunc(scaled)
+    rounded += np.copysign(np.abs(scaled - rounded) >= 0.5, scaled)
+    return rounded.astype(np.int64)
+
+
+def bulk_index(data, ikeys):
+    """Index several arrays into one shared value table in a single pass.
+    Values are numbered by first occurrence, exactly as make_index does"""
+    sizes = [len(data[k]) for k in ikeys]
+    vals = np.concatenate([np.asarray(data[k], dtype='d') for k in ikeys])
+    vals = round_floats(vals, CONFIG['roundPrecision'])
+    table, index = rank_values(vals)
+    data['values'] = table.tolist()
+    for ikey, chunk in zip(ikeys, np.split(index, np.cumsum(sizes)[:-1])):
+        data[ikey + "Index"] = chunk.tolist()
+        del data[ikey]
+
+
+def rank_values(vals):
+    """Number the values of an array by where each first occurs.  Returns
+    the table of distinct values and the index of every value into it"""
+    # sort once, then number each run of equal values
+    perm = vals.argsort()
+    ordered = vals[perm]
+    new = np.ones(len(vals), dtype=bool)
+    new[1:] = ordered[1:] != ordered[:-1]
+    starts = np.flatnonzero(new)
+    # renumber the runs by where each value first occurs
+    first = np.minimum.reduceat(perm, starts) if len(vals) else perm
+    order = first.argsort()
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    index = np.empty_like(perm)
+    index[perm] = rank[np.cumsum(new) - 1]
+    return vals[first[order]], index
+
+
 def compress_shell_colors(data):
     """Color compression"""
+    if np is not None:
+        data['colorsData'] = color_runs(data['colors'])
+        del data['colors']
+        return
     num_tuples = len(data['colors']) / 3
     data['colorsData'] = []
     start = 0
@@ -179,10 +472,20 @@ def compress_shell_colors(data):
     del data['colors']
 
 
+def color_runs(colors):
+    """Run-length encode colors, finding every block boundary at once"""
+    colors = np.asarray(colors, dtype='d').reshape(-1, 3)
+    changed = (colors[1:] != colors[:-1]).any(axis=1)
+    starts = np.concatenate(([0], np.flatnonzero(changed) + 1))
+    durations = np.diff(np.append(starts, len(colors)))
+    return [dict(data=c, duration=d) for c, d in
+            zip(colors[starts].tolist(), durations.tolist())]
+
+
 #------------------------------------------------------------------------------
 
-def translate_shell(shell):
-    """Translates a shell"""
+def translate_shell(shell, lods=False):
+    """Translates a shell, optionally with its levels of detail"""
     if 'href' in shell.attrib:
         # Do href here
         return {
@@ -192,49 +495,530 @@ def translate_shell(shell):
             'href': shell.attrib['href'].replace("xml", "json")
         }
     else:
-        # Convert XML point/vert/color to new way
-        points = load_points(shell.iter("verts"))
-        default_color = parse_color(shell.attrib.get('color', DEFAULT_COLOR))
-        data = dict(id=shell.attrib['id'], size=0)
-        data.update({x: [] for x in ('points', 'normals', 'colors')})
-        for facet in shell.iter('facets'):
-            color = default_color
-            if 'color' in facet.attrib:
-                color = parse_color(facet.attrib['color'])
-            for f in facet.iter('f'):
-                # Get every vertex index and convert using points array
-                index_vals = f.attrib['v'].split(" ")
-                for i in range(3):
-                    ival = int(index_vals[i]) * 3
-                    data['points'].append(float(points[ival]))
-                    data['points'].append(float(points[ival + 1]))
-                    data['points'].append(float(points[ival + 2]))
-
-                # Get the vertex normals
-                norms = [x for x in f.iter('n')]
-                for i in range(3):
-                    norm_coordinates = norms[i].attrib['d'].split(" ")
-                    for j in range(3):
-                        data['normals'].append(float(norm_coordinates[j]))
-
-                # Get the vertex colors
-                for i in range(3):
-                    for c in ('r', 'g', 'b'):
-                        data['colors'].append(color[c])
+        geometry = shell_geometry(shell)
+        data = new_shell(shell.attrib)
+        if lods:
+            return finish_shell_file(data, geometry)
+        finish_shell(data, geometry)
+        return data
+
+
+def shell_geometry(shell):
+    """Convert the XML point/vert/color of a shell element to raw geometry"""
+    geometry = new_geometry(load_points(shell.iter("verts")))
+    default_color = parse_color(shell.attrib.get('color', DEFAULT_COLOR))
+    for facet in shell.iter('facets'):
+        color = facet_color(facet.attrib, default_color)
+        for f in facet.iter('f'):
+            norms = [n.attrib['d'] for n in f.iter('n')]
+            add_facet(geometry, f.attrib['v'], norms, color)
+    return geometry
+
+
+def translate_shell_file(shell):
+    """Translates the shell of an external file"""
+    return translate_shell(shell, lods=True)
+
+
+def stream_shell(path, span=None):
+    """Translates an external shell file as it is parsed, optionally only
+    the facets in one span of it, see facet_spans"""
+    return stream_xml(path, ShellTarget, span)
+
+
+class ShellTarget(object):
+    """XMLParser target that translates shell elements as they arrive, so
+    no element tree is ever built"""
+
+    def __init__(self):
+        self.shell = None
+        self.geometry = new_geometry(array('d'))
+        self.default_color = None
+        self.color = None
+        self.facet = None
+        self.normals = []
+
+    def start(self, tag, attrib):
+        """Consume an opening tag"""
+        if tag == 'v':
+            points = self.geometry['points']
+            points.extend(float(x) for x in attrib['p'].split(" "))
+        elif tag == 'n':
+            self.normals.append(attrib['d'])
+        elif tag == 'f':
+            self.facet = attrib['v']
+            self.normals = []
+        elif tag == 'facets':
+            self.color = facet_color(attrib, self.default_color)
+        elif tag == 'shell':
+            self.shell = new_shell(attrib)
+            color = attrib.get('color', DEFAULT_COLOR)
+            self.default_color = parse_color(color)
+
+    def end(self, tag):
+        """Consume a closing tag"""
+        if tag == 'f':
+            add_facet(self.geometry, self.facet, self.normals, self.color)
+
+    def close(self):
+        """Finish the shell once the document is complete"""
+        return finish_shell_file(self.shell, self.geometry)
+
+
+def new_shell(attrib):
+    """Create the empty JSON for a shell"""
+    return dict(id=attrib['id'], size=0)
+
+
+def new_geometry(points):
+    """Create the raw geometry of a shell, filled in facet by facet.  Facets
+    keep their vertex indices and colors are kept as [color, facets] runs"""
+    return {
+        'points': points,
+        'facets': array('l'),
+        'normals': array('d'),
+        'colors': []
+    }
 
+
+def facet_color(attrib, default_color):
+    """Get the color of a facets group"""
+    if 'color' in attrib:
+        return parse_color(attrib['color'])
+    return default_color
+
+
+def add_facet(geometry, vertices, normals, color):
+    """Append a single facet to the raw shell geometry"""
+    # Keep the vertex indices, points are gathered during assembly
+    index_vals = vertices.split(" ")
+    geometry['facets'].extend(int(index_vals[i]) for i in range(3))
+
+    # Get the vertex normals
+    for i in range(3):
+        norm_coordinates = normals[i].split(" ")
+        for j in range(3):
+            geometry['normals'].append(float(norm_coordinates[j]))
+
+    # Extend the current color run
+    runs = geometry['colors']
+    if runs and runs[-1][0] is color:
+        runs[-1][1] += 1
+    else:
+        runs.append([color, 1])
+
+
+def assemble_shell(data, geometry):
+    """Expand the raw geometry into per-vertex points and normals, and
+    per-vertex or per-facet colors"""
+    rgb = lambda c: [c['r'], c['g'], c['b']]
+    repeat = 1 if CONFIG['facetColors'] else 3
+    if np is not None:
+        points = geometry['points']
+        points = np.frombuffer(points, dtype=points.typecode).reshape(-1, 3)
+        facets = np.frombuffer(geometry['facets'], dtype='l')
+        data['points'] = points[facets].ravel()
+        data['normals'] = np.frombuffer(geometry['normals'], dtype='d')
+        palette = np.array([rgb(c) for c, _ in geometry['colors']])
+        counts = [n * repeat for _, n in geometry['colors']]
+        colors = np.repeat(palette.reshape(-1, 3), counts, axis=0)
+        data['colors'] = colors.ravel()
+    else:
+        points = geometry['points']
+        data['points'] = [points[i * 3 + j]
+                          for i in geometry['facets'] for j in xrange(3)]
+        data['normals'] = geometry['normals'].tolist()
+        data['colors'] = []
+        for color, count in geometry['colors']:
+            data['colors'].extend(rgb(color) * repeat * count)
+    if CONFIG['facetColors']:
+        data['colorsPerFacet'] = True
+
+
+def quantize_geometry(data, geometry):
+    """Quantize the points of the raw geometry to integers of the configured
+    bits relative to their bounding box.  The scale and offset that restore
+    them are kept as data['quantization'].  Returns the geometry with the
+    quantized points."""
+    bits = CONFIG['quantizeBits']
+    steps = (1 << bits - 1) - 1
+    points = geometry['points']
+    if not points:
+        return geometry
+    coords = [points[i::3] for i in xrange(3)]
+    low = [min(c) for c in coords]
+    high = [max(c) for c in coords]
+    offset = [(l + h) / 2 for l, h in zip(low, high)]
+    scale = [(h - l) / (2 * steps) or 1.0 for l, h in zip(low, high)]
+    if np is not None:
+        pts = np.frombuffer(points, dtype='d').reshape(-1, 3)
+        quantized = np.floor((pts - offset) / scale + 0.5).astype('l')
+        quantized = array('l', quantized.ravel().tobytes())
+    else:
+        quantized = array('l', (int(math.floor((x - offset[i % 3]) /
+                                               scale[i % 3] + 0.5))
+                                for i, x in enumerate(points)))
+    data['quantization'] = {'bits': bits, 'scale': scale, 'offset': offset}
+    return dict(geometry, points=quantized)
+
+
+def encode_normals(normals, bits):
+    """Octahedral encoding of normals (Meyer et al. 2010), each as two
+    signed integers of the given bits.  The normal is projected onto the
+    octahedron and the lower half folded over the upper."""
+    steps = (1 << bits - 1) - 1
+    if np is not None:
+        n = np.asarray(normals, dtype='d').reshape(-1, 3)
+        length = np.abs(n).sum(axis=1)
+        length[length == 0] = 1.0
+        x = n[:, 0] / length
+        y = n[:, 1] / length
+        folded = [(1 - np.abs(y)) * np.where(x >= 0, 1, -1),
+                  (1 - np.abs(x)) * np.where(y >= 0, 1, -1)]
+        south = n[:, 2] < 0
+        x, y = np.where(south, folded[0], x), np.where(south, folded[1], y)
+        pairs = np.column_stack([x, y])
+        return np.floor(pairs * steps + 0.5).astype(np.int64).ravel()
+    encoded = []
+    for i in xrange(0, len(normals), 3):
+        x, y, z = normals[i:i + 3]
+        length = abs(x) + abs(y) + abs(z) or 1.0
+        x, y = x / length, y / length
+        if z < 0:
+            x, y = ((1 - abs(y)) * (1 if x >= 0 else -1),
+                    (1 - abs(x)) * (1 if y >= 0 else -1))
+        encoded.extend(int(math.floor(v * steps + 0.5)) for v in (x, y))
+    return encoded
+
+
+def flat_runs(flat):
+    """Run lengths of facets alternately flat and not, starting with flat"""
+    runs = [0]
+    for f in flat:
+        # the runs at even positions are the flat ones
+        if (len(runs) % 2 == 1) != f:
+            runs.append(0)
+        runs[-1] += 1
+    return runs
+
+
+def pack_normals(data):
+    """Replace the vertex normals of an assembled shell by octahedral ones.
+    Flat facets, whose vertex normals encode the same, keep one normal.
+    The facets keeping one are listed in runs as data['flatFacets']."""
+    bits = CONFIG['octNormals']
+    encoded = encode_normals(data['normals'], bits)
+    if np is not None:
+        facets = encoded.reshape(-1, 3, 2)
+        flat = ((facets[:, 0] == facets[:, 1]).all(axis=1) &
+                (facets[:, 0] == facets[:, 2]).all(axis=1))
+        keep = np.ones(facets.shape[:2], dtype=bool)
+        keep[flat, 1:] = False
+        data['normals'] = facets[keep].ravel()
+        flat = flat.tolist()
+    else:
+        flat = []
+        data['normals'] = []
+        for i in xrange(0, len(encoded), 6):
+            facet = encoded[i:i + 6]
+            flat.append(facet[:2] == facet[2:4] == facet[4:])
+            data['normals'].extend(facet[:2] if flat[-1] else facet)
+    data['octahedral'] = bits
+    data['flatFacets'] = flat_runs(flat)
+
+
+def weld_shell(data, geometry):
+    """Weld the raw geometry into a buffer of distinct vertices, each a
+    point, normal and color, plus three vertex indices per facet.  Points
+    and normals are rounded to the configured precision before welding,
+    unless they are quantized or octahedral.  Vertices are numbered by
+    first use."""
+    precision = CONFIG['roundPrecision']
+    bits = CONFIG['octNormals']
+    quantized = 'quantization' in data
+    digits = 0 if quantized else precision
+    rgb = lambda c: [c['r'], c['g'], c['b']]
+    data['size'] = len(geometry['facets']) / 3
+    if precision and not (quantized and bits):
+        data['precision'] = precision
+    if bits:
+        data['octahedral'] = bits
+    if np is not None:
+        points = geometry['points']
+        points = np.frombuffer(points, dtype=points.typecode).reshape(-1, 3)
+        points = points[np.frombuffer(geometry['facets'], dtype='l')]
+        normals = np.frombuffer(geometry['normals'], dtype='d')
+        if bits:
+            normals = encode_normals(normals, bits).reshape(-1, 2)
+        else:
+            normals = round_floats(normals.reshape(-1, 3), precision)
+        palette = np.array([rgb(c) for c, _ in geometry['colors']])
+        counts = [n * 3 for _, n in geometry['colors']]
+        colors = np.repeat(palette.reshape(-1, 3) * 255, counts, axis=0)
+        rows = np.hstack([round_floats(points, digits), normals,
+                          np.round(colors)]).astype('d')
+        # adding zero turns -0.0 into 0.0, which compare equal bytewise
+        rows = np.ascontiguousarray(rows + 0.0)
+        width = rows.shape[1]
+        keys = rows.view(np.dtype((np.void, rows.itemsize * width))).ravel()
+        table, index = rank_values(keys)
+        table = table.view('d').reshape(-1, width)
+        points, normals = table[:, :3], table[:, 3:-3]
+        data['points'] = (points.astype(np.int64) if digits or quantized
+                          else points).ravel()
+        data['normals'] = (normals.astype(np.int64) if precision or bits
+                           else normals).ravel()
+        data['colors'] = (table[:, -3:] / 255.0).ravel()
+        data['indices'] = index
+        return
+    points = geometry['points']
+    normals = geometry['normals']
+    if bits:
+        normals = encode_normals(normals, bits)
+        normal = lambda i: tuple(normals[i * 2:i * 2 + 2])
+    else:
+        normal = lambda i: tuple(round_float(normals[i * 3 + j], precision)
+                                 for j in xrange(3))
+    colors = [tuple(rgb(c)) for c, n in geometry['colors'] for _ in xrange(n)]
+    vertices = {}
+    data['indices'] = []
+    for i, v in enumerate(geometry['facets']):
+        key = (tuple(round_float(points[v * 3 + j], digits)
+                     for j in xrange(3)) + normal(i) + colors[i / 3])
+        if key not in vertices:
+            vertices[key] = len(vertices)
+        data['indices'].append(vertices[key])
+    table = sorted(vertices, key=vertices.get)
+    data['points'] = [x for entry in table for x in entry[:3]]
+    data['normals'] = [x for entry in table for x in entry[3:-3]]
+    data['colors'] = [x for entry in table for x in entry[-3:]]
+
+
+def cache_misses(indices, size):
+    """Vertex cache misses drawing an index list through a FIFO cache"""
+    cached = set()
+    fifo = deque()
+    misses = 0
+    for v in indices:
+        if v not in cached:
+            misses += 1
+            cached.add(v)
+            fifo.append(v)
+            if len(fifo) > size:
+                cached.discard(fifo.popleft())
+    return misses
+
+
+def tipsify(indices, size):
+    """Order the triangles of an index list for a vertex cache of the given
+    size, by Tipsify (Sander, Nehab and Barczak 2007).  Triangles are fanned
+    around a vertex at a time, moving on to the vertex likely still cached
+    that has the most triangles left.  Returns the triangle order."""
+    count = len(indices) / 3
+    adjacent = {}
+    sequence = []
+    for t in xrange(count):
+        for v in indices[t * 3:t * 3 + 3]:
+            if v not in adjacent:
+                adjacent[v] = []
+                sequence.append(v)
+            adjacent[v].append(t)
+    live = dict((v, len(ts)) for v, ts in adjacent.iteritems())
+    stamp = dict.fromkeys(adjacent, 0)
+    emitted = [False] * count
+    dead_end = []
+    order = []
+    time = size + 1
+    cursor = 0
+    fan = sequence[0] if sequence else None
+    while fan is not None:
+        candidates = []
+        for t in adjacent[fan]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            order.append(t)
+            for v in indices[t * 3:t * 3 + 3]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - stamp[v] > size:
+                    stamp[v] = time
+                    time += 1
+        # the candidate still in cache with the most triangles left
+        fan, best = None, -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - stamp[v] + 2 * live[v] <= size:
+                    priority = time - stamp[v]
+                if priority > best:
+                    fan, best = v, priority
+        while fan is None and dead_end:
+            v = dead_end.pop()
+            if live[v] > 0:
+                fan = v
+        while fan is None and cursor < len(sequence):
+            if live[sequence[cursor]] > 0:
+                fan = sequence[cursor]
+            cursor += 1
+    return order
+
+
+def optimize_cache(data, runs):
+    """Reorder the facets of a welded shell for the vertex cache, within
+    each run of facets of one color, then renumber the vertices by first
+    use for fetch locality.  Returns the facet count and the cache misses
+    before and after."""
+    size = CONFIG['vertexCache']
+    indices = data['indices']
+    if not isinstance(indices, list):
+        indices = indices.tolist()
+    before = cache_misses(indices, size)
+    order = []
+    start = 0
+    for count in runs:
+        run = indices[start * 3:(start + count) * 3]
+        order.extend(start + t for t in tipsify(run, size))
+        start += count
+    indices = [indices[t * 3 + j] for t in order for j in xrange(3)]
+    number = {}
+    for v in indices:
+        if v not in number:
+            number[v] = len(number)
+    perm = sorted(number, key=number.get)
+    for key in ('points', 'normals', 'colors'):
+        # octahedral normals have two elements per vertex
+        n = len(data[key]) / len(perm) if perm else 3
+        if np is not None:
+            data[key] = np.asarray(data[key]).reshape(-1, n)[perm].ravel()
+        else:
+            data[key] = [data[key][v * n + j] for v in perm for j in xrange(n)]
+    data['indices'] = [number[v] for v in indices]
+    after = cache_misses(data['indices'], size)
+    return [len(order), before, after]
+
+
+def finish_shell(data, geometry):
+    """Assemble, index and compress the shell data.  Returns the vertex
+    cache statistics of its layout, see layout_shell"""
+    stats = layout_shell(data, geometry)
+    index_shell(data)
+    if CONFIG.get('compressColors'):
+        compress_shell_colors(data)
+    plain_values(data)
+    return stats
+
+
+def finish_shell_file(data, geometry):
+    """Finish the shell of an external file and add its levels of detail.
+    Its vertex cache statistics ride along as data['vertexCache'] for the
+    translator, which takes them out before the shell is written."""
+    stats = finish_shell(data, geometry)
+    if stats:
+        data['vertexCache'] = stats
+    return shell_lods(data, geometry)
+
+
+def layout_shell(data, geometry):
+    """Lay out the shell data from its raw geometry, welded or expanded.
+    Returns the vertex cache statistics of an optimized layout, else None"""
+    if CONFIG['quantizeBits']:
+        geometry = quantize_geometry(data, geometry)
+    if CONFIG['weldVertices']:
+        weld_shell(data, geometry)
+        if CONFIG['optimizeCache']:
+            return optimize_cache(data, [n for _, n in geometry['colors']])
+    else:
+        assemble_shell(data, geometry)
         data['size'] = len(data['points']) / 9
-        indexing = [x for x in CONFIG if x.startswith('index') and CONFIG[x]]
-        for i in indexing:
-            data['precision'] = CONFIG['roundPrecision']
-            if 'values' not in data:
-                data['values'] = {}
-            globals()[i](data)
-        if indexing:
+        if CONFIG['octNormals']:
+            pack_normals(data)
+
+
+def index_shell(data):
+    """Index the values of an expanded shell, as configured"""
+    if 'indices' in data:
+        return
+    # quantized points and octahedral normals are written as they are
+    packed = {'points': 'quantization', 'normals': 'octahedral'}
+    indexing = [x for x in INDEXING
+                if CONFIG[x[0]] and packed[x[1]] not in data]
+    if indexing:
+        data['precision'] = CONFIG['roundPrecision']
+        if np is not None:
+            bulk_index(data, [ikey for _, ikey in indexing])
+        else:
+            data['values'] = {}
+            for i, _ in indexing:
+                globals()[i](data)
             sorted_vals = sorted(data['values'].items(), key=itemgetter(1))
             data['values'] = map(itemgetter(0), sorted_vals)
-        if CONFIG.get('compressColors'):
-            compress_shell_colors(data)
-        return data
+
+
+def plain_values(data):
+    """Anything left uncompressed is written out as plain values"""
+    for key in ('points', 'normals', 'colors', 'indices'):
+        if key in data and not isinstance(data[key], list):
+            data[key] = data[key].tolist()
+
+
+def merge_shells(parts):
+    """Joins the translations of consecutive facet ranges of one shell into
+    the translation of the whole shell.  The first range is reused for the
+    result, keeping the key order of a shell translated whole."""
+    data = parts[0]
+    data['size'] = sum(p['size'] for p in parts)
+    if 'indices' in data:
+        # welded ranges keep their own vertices, numbered after the last
+        starts = [0]
+        for p in parts[:-1]:
+            starts.append(starts[-1] + len(p['points']) / 3)
+        data['indices'] = [i + start for p, start in zip(parts, starts)
+                           for i in p['indices']]
+    for key in ('points', 'normals', 'colors'):
+        if key in data:
+            data[key] = [x for p in parts for x in p[key]]
+    if 'values' in data:
+        # renumber the values shell wide, by first occurrence
+        ikeys = [ikey for _, ikey in INDEXING if ikey + 'Index' in data]
+        if np is not None:
+            vals = np.concatenate([np.asarray(p['values'])[p[ikey + 'Index']]
+                                   for ikey in ikeys for p in parts])
+            table, index = rank_values(vals)
+            data['values'] = table.tolist()
+            sizes = [sum(len(p[ikey + 'Index']) for p in parts)
+                     for ikey in ikeys]
+            chunks = np.split(index, np.cumsum(sizes)[:-1])
+            for ikey, chunk in zip(ikeys, chunks):
+                data[ikey + 'Index'] = chunk.tolist()
+        else:
+            tables = [p['values'] for p in parts]
+            chunks = [[p[ikey + 'Index'] for p in parts] for ikey in ikeys]
+            values = {}
+            for ikey, ranges in zip(ikeys, chunks):
+                indexes = data[ikey + 'Index'] = []
+                for table, chunk in zip(tables, ranges):
+                    for i in chunk:
+                        val = table[i]
+                        if val not in values:
+                            values[val] = len(values)
+                        indexes.append(values[val])
+            data['values'] = sorted(values, key=values.get)
+    if 'flatFacets' in data:
+        data['flatFacets'] = flat_runs(i % 2 == 0 for p in parts
+                                       for i, n in enumerate(p['flatFacets'])
+                                       for _ in xrange(n))
+    if 'colorsData' in data:
+        # runs continue across the range boundaries
+        runs = []
+        for run in [x for p in parts for x in p['colorsData']]:
+            if runs and runs[-1]['data'] == run['data']:
+                runs[-1]['duration'] += run['duration']
+            else:
+                runs.append(dict(run))
+        data['colorsData'] = runs
+    return data
 
 
 def parse_color(hex_color):
@@ -246,211 +1030,1146 @@ def parse_color(hex_color):
 
 def load_points(verts):
     """Load all of the point information"""
-    points = []
+    points = array('d')
     for vert in verts:
         for v in vert:
-            points.extend(v.attrib['p'].split(" "))
+            points.extend(float(x) for x in v.attrib['p'].split(" "))
     return points
 
 
 #------------------------------------------------------------------------------
 
-class WorkerBase(Process):
-    """Base class for Workers"""
+def lod_name(name, level):
+    """Name of a file or batch at a level of detail, level 0 being the
+    full detail one"""
+    if not level:
+        return name
+    base, extension = os.path.splitext(name)
+    return "{}.lod{}{}".format(base, level, extension)
+
+
+def remove_output(path):
+    """Remove an output file and its compressed copies, if there are any"""
+    for extension in [''] + [e for e, _ in SIDECARS.values()]:
+        if os.path.isfile(path + extension):
+            os.remove(path + extension)
+
+
+def remove_lods(name, levels, extensions=('',)):
+    """Remove the levels of detail of an output beyond the first levels,
+    left over from a run that wrote more of them"""
+    for level in xrange(levels + 1, len(CONFIG['lodCells']) + 1):
+        for extension in extensions:
+            remove_output(lod_name(name, level) + extension)
+
+
+def cluster_points(points, cells):
+    """Vertex clustering.  Points in the same cell of a grid, with cells
+    along the longest side of their bounding box, merge into their mean.
+    Returns the cluster of each point, the merged points and the farthest
+    any point moved."""
+    if np is not None:
+        pts = np.frombuffer(points, dtype='d').reshape(-1, 3)
+        low = pts.min(axis=0)
+        step = (pts.max(axis=0) - low).max() / cells or 1.0
+        cell = ((pts - low) / step).astype(np.int64)
+        keys = (cell[:, 0] * (cells + 1) + cell[:, 1]) * (cells + 1)
+        _, cluster = np.unique(keys + cell[:, 2], return_inverse=True)
+        counts = np.bincount(cluster).astype('d')
+        merged = np.column_stack([np.bincount(cluster, pts[:, i]) / counts
+                                  for i in xrange(3)])
+        moved = ((pts - merged[cluster]) ** 2).sum(axis=1).max()
+        return cluster, merged.ravel().tolist(), math.sqrt(moved)
+    coords = [points[i::3] for i in xrange(3)]
+    low = [min(c) for c in coords]
+    step = max(max(c) - l for c, l in zip(coords, low)) / cells or 1.0
+    clusters = {}
+    cluster = []
+    sums = []
+    for i in xrange(0, len(points), 3):
+        p = points[i:i + 3]
+        key = tuple(int((p[j] - low[j]) / step) for j in xrange(3))
+        if key not in clusters:
+            clusters[key] = len(sums)
+            sums.append([0.0, 0.0, 0.0, 0])
+        c = clusters[key]
+        for j in xrange(3):
+            sums[c][j] += p[j]
+        sums[c][3] += 1
+        cluster.append(c)
+    merged = [s[j] / s[3] for s in sums for j in xrange(3)]
+    moved = max(sum((points[i * 3 + j] - merged[c * 3 + j]) ** 2
+                    for j in xrange(3)) for i, c in enumerate(cluster))
+    return cluster, merged, math.sqrt(moved)
+
+
+def surviving_facets(facets, cluster):
+    """Facets still spanning three clusters, each kept once.  Returns their
+    numbers and their vertices as cluster numbers."""
+    if np is not None:
+        tris = cluster[np.frombuffer(facets, dtype='l').reshape(-1, 3)]
+        kept = np.flatnonzero((tris[:, 0] != tris[:, 1]) &
+                              (tris[:, 1] != tris[:, 2]) &
+                              (tris[:, 0] != tris[:, 2]))
+        if not len(kept):
+            return [], []
+        _, first = np.unique(np.sort(tris[kept], axis=1), axis=0,
+                             return_index=True)
+        kept = np.sort(kept[first])
+        return kept.tolist(), tris[kept].ravel().tolist()
+    kept = []
+    vertices = []
+    seen = set()
+    for f in xrange(len(facets) / 3):
+        tri = [cluster[v] for v in facets[f * 3:f * 3 + 3]]
+        key = tuple(sorted(tri))
+        if len(set(tri)) == 3 and key not in seen:
+            seen.add(key)
+            kept.append(f)
+            vertices.extend(tri)
+    return kept, vertices
+
+
+def simplify_geometry(geometry, cells):
+    """Simplifies raw shell geometry by vertex clustering.  Facets keep
+    their vertex normals and colors.  Returns the simplified geometry and
+    its error bound, or None when no facet is left."""
+    cluster, points, error = cluster_points(geometry['points'], cells)
+    kept, vertices = surviving_facets(geometry['facets'], cluster)
+    if not kept:
+        return None
+    simple = new_geometry(array('d', points))
+    simple['facets'].extend(vertices)
+    normals = geometry['normals']
+    colors = [c for c, n in geometry['colors'] for _ in xrange(n)]
+    runs = simple['colors']
+    for f in kept:
+        simple['normals'].extend(normals[f * 9:f * 9 + 9])
+        if runs and runs[-1][0] is colors[f]:
+            runs[-1][1] += 1
+        else:
+            runs.append([colors[f], 1])
+    return simple, error
 
-    def __init__(self, queue, exceptions):
-        Process.__init__(self)
-        self.queue = queue
-        self.exceptions = exceptions
 
-    def report_exception(self, job, reason):
-        """Report a job exception"""
-        info = dict(reason=reason)
-        info.update(job)
-        self.exceptions.put(info)
+def shell_lods(data, geometry):
+    """Adds the configured levels of detail to a translated shell, each a
+    shell of its own with the error bound of its simplification.  A level
+    without fewer facets than the one before it is left out."""
+    levels = CONFIG['lodCells'][:CONFIG['lodLevels']]
+    if not levels or not geometry['facets']:
+        return data
+    data['lods'] = []
+    facets = len(geometry['facets'])
+    for cells in levels:
+        simple = simplify_geometry(geometry, cells)
+        if not simple or len(simple[0]['facets']) >= facets:
+            continue
+        facets = len(simple[0]['facets'])
+        lod = new_shell(data)
+        finish_shell(lod, simple[0])
+        lod['error'] = simple[1]
+        data['lods'].append(lod)
+    return data
 
-    def run(self):
-        raise NotImplementedError
 
+def merge_lods(parts):
+    """Joins the levels of detail of the facet ranges of a split shell.  A
+    range short of a level joins it with its coarsest one, and a joined
+    level without fewer facets than the one before it is left out."""
+    ranges = [p.pop('lods', []) for p in parts]
+    size = sum(p['size'] for p in parts)
+    lods = []
+    for n in xrange(max(len(x) for x in ranges)):
+        # copies, as joining reuses the first of them
+        level = [dict(x[min(n, len(x) - 1)]) if x else dict(p, error=0.0)
+                 for p, x in zip(parts, ranges)]
+        error = max(x['error'] for x in level)
+        lod = merge_shells(level)
+        if lod['size'] >= size:
+            continue
+        size = lod['size']
+        lod['error'] = error
+        lods.append(lod)
+    return lods
+
+
+def geometry_key(data):
+    """Hash of a translated shell's geometry with its points moved to start
+    at the origin, and where they started.  Shells that differ only by a
+    translation share the hash."""
+    def unindex(key):
+        if key + 'Index' in data:
+            if np is not None:
+                values = np.asarray(data['values'])
+                return values[data[key + 'Index']].tolist()
+            return [data['values'][i] for i in data[key + 'Index']]
+        return data.get(key, [])
+    points = unindex('points')
+    quantization = dict(data.get('quantization', {}))
+    if quantization:
+        # quantized points are already relative to their bounding box,
+        # whose size moved copies only share to within rounding
+        start = quantization.pop('offset')
+        quantization['scale'] = ['%.9g' % x for x in quantization['scale']]
+        moved = points
+    else:
+        start = [min(points[i::3]) if points else 0 for i in xrange(3)]
+        moved = [x - start[i % 3] for i, x in enumerate(points)]
+        if 'precision' in data:
+            start = [x / math.pow(10, data['precision']) for x in start]
+    colors = data.get('colorsData', data.get('colors'))
+    key = [data.get('precision'), quantization, data.get('octahedral'),
+           data.get('colorsPerFacet', False), moved, unindex('normals'),
+           data.get('flatFacets'), colors, data.get('indices')]
+    return hashlib.sha1(json.dumps(key)).hexdigest(), start
+
+
+def shell_summary(job, data):
+    """What the translator keeps of a translated shell: its vertex cache
+    statistics, the triangle counts and error bounds of its levels of
+    detail, and the key of its geometry when deduplicating.  A pipelined
+    shell is spooled for its batch, and its spool file is carried along as
+    'shell'.  None for other files."""
+    if job.get('type') != 'shell':
+        return None
+    summary = {}
+    if 'vertexCache' in data:
+        summary['vertexCache'] = data.pop('vertexCache')
+    if data.get('lods'):
+        summary['lods'] = [{'size': x['size'], 'error': x['error']}
+                           for x in data['lods']]
+    if job.get('dedupe'):
+        summary['geometry'] = geometry_key(data)
+    if 'batch' in job:
+        summary['shell'] = spool_shell(job, data)
+    return summary
+
+
+def spool_shell(job, data):
+    """Park a pipelined shell in the spool directory, for the worker that
+    assembles its batch.  Returns the spool file."""
+    path = join(job['spool'], job['shell'] + ".pickle")
+    with open(path, 'wb') as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def unspool_shell(path):
+    """Take a pipelined shell out of the spool directory"""
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    os.remove(path)
+    return data
 
-class BatchWorker(WorkerBase):
-    """Worker process for parallelized shell batching"""
 
-    def run(self):
-        """Process jobs"""
-        while True:
-            job = self.queue.get()
-            if job is None:
-                break
-            # process shells
-            batch = {'shells': []}
-            indexed = CONFIG['indexPoints'] or CONFIG['indexNormals']
-            reindex = job['reindex'] and indexed
-            use_tyson = job['use_tyson']
-            if reindex:
-                batch['values'] = {}
-            for s in job['shells']:
-                try:
-                    with open(join(job['path'], s)) as f:
-                        shell = json.load(f)
-                    sid = SHELL_REGEX.match(s).group(1)
-                    shell['id'] = sid
-                    if reindex:
-                        imap = {}
-                        for i, value in enumerate(shell['values']):
-                            if value not in batch['values']:
-                                batch['values'][value] = len(batch['values'])
-                            imap[i] = batch['values'][value]
-                        del shell['values']
-                        for item in ('points', 'normals'):
-                            idx = item + 'Index'
-                            if idx in shell:
-                                shell[idx] = [imap[x] for x in shell[idx]]
-                    batch['shells'].insert(0, shell)
-                except Exception as e:
-                    reason = "Error batching shell '{}': {}".format(s, e)
-                    self.report_exception(job, reason)
-                    continue
-            # transform values to list
-            if reindex:
-                sorted_v = sorted(batch['values'].items(), key=itemgetter(1))
-                batch['values'] = map(itemgetter(0), sorted_v)
-            # write batch
-            extension = use_tyson and ".tyson" or ".json"
-
-            out_path = join(job['path'], job['name'] + extension)
-            try:
-                with open(out_path, "w") as f:
-                    if use_tyson:
-                        TysonEncoder().encode(batch, f)
-                        f.flush();
-                        # Must add padding for now to avoid a chrome bug
-                        f.seek(0,2)
-                        f_size = f.tell()
-                        for i in range(0, 8 - (f_size % 8)):
-                            f.write(chr(0))
-                    else:
-                        json.dump(batch, f)
-            except Exception as e:
-                reason = "Unable to output JSON '{}': {}.".format(out_path, e)
-                self.report_exception(job, reason)
+#------------------------------------------------------------------------------
 
+def file_digest(path):
+    """Hash of a source file's content and the output affecting settings"""
+    digest = hashlib.sha1(json.dumps([CONFIG[k] for k in CACHE_CONFIG]))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_cache(xml_dir):
+    """Reads the translation cache of a directory, empty if there is none"""
+    try:
+        with open(join(xml_dir, CACHE_FILE)) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    cache.setdefault('files', {})
+    cache.setdefault('batches', {})
+    return cache
+
+
+def save_cache(xml_dir, cache):
+    """Replaces the translation cache of a directory"""
+    path = join(xml_dir, CACHE_FILE)
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        LOG.warning("Unable to write cache '{}': {}".format(path, e))
 
-class TranslationWorker(WorkerBase):
-    """Worker process for parallelized translation"""
 
-    def run(self):
-        """Process jobs"""
-        while True:
-            job = self.queue.get()
-            if job is None:
-                break
-            path = job['path']
+#------------------------------------------------------------------------------
+
+def dump_batch(batch, f):
+    """Writes a batch as JSON, byte for byte as json.dump would, returning
+    the (offset, length) spans of its members and of each of its shells"""
+    members = {}
+    shells = []
+    f.write('{')
+    for n, (key, value) in enumerate(batch.items()):
+        f.write((n and ', ' or '') + json.dumps(key) + ': ')
+        start = f.tell()
+        if key == 'shells':
+            f.write('[')
+            for i, shell in enumerate(value):
+                if i:
+                    f.write(', ')
+                offset = f.tell()
+                json.dump(shell, f)
+                shells.append((offset, f.tell() - offset))
+            f.write(']')
+        else:
+            json.dump(value, f)
+        members[key] = (start, f.tell() - start)
+    f.write('}')
+    return members, shells
+
+
+def tyson_spans(path):
+    """The (offset, length) spans of the members and shells of a TySON
+    batch file"""
+    with TysonReader(path) as reader:
+        members = dict((key, (offset, reader.extent(offset)))
+                       for key, offset in reader.members().items())
+        shells = [(offset, reader.extent(offset))
+                  for offset in reader.item_offsets('shells')]
+    return members, shells
+
+
+def batch_manifest(batch, members, shells, bboxes):
+    """Lists where each shell of a batch lies in the batch file, so shells
+    can be fetched with range requests"""
+    manifest = {'shells': []}
+    if 'values' in batch:
+        offset, length = members['values']
+        manifest['values'] = {'offset': offset, 'length': length}
+    for shell, (offset, length) in zip(batch['shells'], shells):
+        entry = {
+            'id': shell['id'],
+            'size': shell['size'],
+            'offset': offset,
+            'length': length
+        }
+        if 'error' in shell:
+            entry['error'] = shell['error']
+        if shell['id'] in bboxes:
+            entry['bbox'] = bboxes[shell['id']]
+        manifest['shells'].append(entry)
+    return manifest
+
+
+def batch_reindex(job):
+    """Whether a batch job shares one value table among its shells"""
+    indexed = ((CONFIG['indexNormals'] and not CONFIG['octNormals']) or
+               (CONFIG['indexPoints'] and not CONFIG['quantizeBits']))
+    return job['reindex'] and indexed and not CONFIG['weldVertices']
+
+
+def new_batch(reindex):
+    """An empty batch, with a shared value table when re-indexing"""
+    batch = {'shells': []}
+    if reindex:
+        batch['values'] = {}
+    return batch
+
+
+def add_to_batch(batch, shell):
+    """Adds a shell to a batch, moving its values into the batch's table"""
+    if 'values' in batch:
+        imap = {}
+        for i, value in enumerate(shell['values']):
+            if value not in batch['values']:
+                batch['values'][value] = len(batch['values'])
+            imap[i] = batch['values'][value]
+        del shell['values']
+        for item in ('points', 'normals'):
+            idx = item + 'Index'
+            if idx in shell:
+                shell[idx] = [imap[x] for x in shell[idx]]
+    batch['shells'].append(shell)
+
+
+def finish_batch(batch):
+    """Puts a batch in its output form"""
+    # shells are written in reverse order of assignment
+    batch['shells'].reverse()
+    # transform values to list
+    if 'values' in batch:
+        sorted_v = sorted(batch['values'].items(), key=itemgetter(1))
+        batch['values'] = map(itemgetter(0), sorted_v)
+    return batch
+
+
+def balance(sizes):
+    """Summarizes how evenly sizes are spread"""
+    mean = float(sum(sizes)) / len(sizes)
+    stdev = math.sqrt(sum((x - mean) ** 2 for x in sizes) / len(sizes))
+    msg = "Count: {} Min: {} Max: {} Mean: {:.0f} Stdev: {:.0f} "
+    msg += "Max/Mean: {:.3f}"
+    return msg.format(len(sizes), min(sizes), max(sizes), mean, stdev,
+                      max(sizes) / mean if mean else 1.0)
+
+
+def parse_bytes(text):
+    """Parse a byte count such as 4096, 512k or 4MB, of at least a byte"""
+    match = BYTES_REGEX.match(text)
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size '{}'".format(text))
+    unit = (match.group(2) or '').lower()
+    size = int(float(match.group(1)) * BYTE_UNITS[unit])
+    if size < 1:
+        msg = "size '{}' is not a positive number of bytes"
+        raise argparse.ArgumentTypeError(msg.format(text))
+    return size
+
+
+def morton_code(x, y, z):
+    """Interleave the bits of three 10 bit cell coordinates"""
+    code = 0
+    for bit in xrange(10):
+        code |= ((x >> bit & 1) << 3 * bit | (y >> bit & 1) << 3 * bit + 1 |
+                 (z >> bit & 1) << 3 * bit + 2)
+    return code
+
+
+def morton_codes(bboxes):
+    """Morton codes of the centers of bounding boxes, on a 1024 cell grid
+    over their extent.  Missing boxes get code 0."""
+    centers = [[(b[i] + b[i + 3]) / 2.0 for i in xrange(3)] if b else None
+               for b in bboxes]
+    known = [c for c in centers if c]
+    if not known:
+        return [0] * len(bboxes)
+    low = [min(c[i] for c in known) for i in xrange(3)]
+    span = [max(c[i] for c in known) - low[i] or 1.0 for i in xrange(3)]
+    cell = lambda c, i: min(1023, int((c[i] - low[i]) / span[i] * 1024))
+    return [morton_code(*[cell(c, i) for i in xrange(3)]) if c else 0
+            for c in centers]
+
+
+# where a worker announces each job it starts, set in every worker
+STARTED = None
+
+
+def start_worker(started):
+    """Initializes a worker process of the pool"""
+    global STARTED
+    STARTED = started
+
+
+def run_job(func, job, ticket):
+    """Runs a job in a worker process.  Returns the job, its result and the
+    reasons it failed, if any; a job never raises."""
+    STARTED.put((ticket, os.getpid()))
+    reasons = []
+    try:
+        result = func(job, reasons)
+    except Exception as e:
+        reasons.append("Unexpected failure: '{}'.".format(e))
+        result = None
+    return job, result, reasons
+
+
+def process_alive(pid):
+    """Whether a process is still there.  The pool reaps dead workers
+    promptly, so they do not linger as zombies."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Scheduler(object):
+    """Pool of worker processes shared by the translation and batching
+    stages.  Jobs start as soon as they are submitted and their outcomes
+    are handed back as they complete.  Jobs lost with a worker that died
+    are handed back as failures."""
+
+    def __init__(self, processes=None, fail_fast=False):
+        self.started = SimpleQueue()
+        self.pool = Pool(processes, start_worker, (self.started,))
+        self.fail_fast = fail_fast
+        self.done = queue.Queue()
+        self.jobs = {}
+        self.running = {}
+        self.orphans = set()
+        self.tickets = 0
+        self.lost = 0
+        self.aborted = False
+
+    def submit(self, func, job):
+        """Queue a job, to be run by func(job, reasons)"""
+        if self.aborted:
+            return
+        ticket = self.tickets
+        self.tickets += 1
+        self.jobs[ticket] = job
+        callback = lambda outcome: self.done.put((ticket, outcome))
+        self.pool.apply_async(run_job, (func, job, ticket), callback=callback)
+
+    def results(self):
+        """Yields (job, result, reasons) as each job completes, until no
+        jobs are pending or the scheduler is aborted"""
+        while self.jobs and not self.aborted:
+            try:
+                outcomes = [self.done.get(timeout=POLL_SECS)]
+            except queue.Empty:
+                outcomes = self.lost_jobs()
+            for ticket, outcome in outcomes:
+                # the late result of a job given up on is dropped
+                if self.jobs.pop(ticket, None) is None:
+                    continue
+                self.running.pop(ticket, None)
+                yield outcome
+                if self.aborted:
+                    return
+
+    def lost_jobs(self):
+        """The outcomes of started jobs whose worker has died since, as
+        their results never come.  A job is only given up on once it is
+        seen orphaned by two checks in a row, so a result still on its
+        way is not taken for lost."""
+        while not self.started.empty():
+            ticket, pid = self.started.get()
+            if ticket in self.jobs:
+                self.running[ticket] = pid
+        orphans = set(t for t, pid in self.running.items()
+                      if t in self.jobs and not process_alive(pid))
+        lost = orphans & self.orphans
+        self.orphans = orphans - lost
+        self.lost += len(lost)
+        msg = "Worker process died running the job."
+        return [(t, (self.jobs[t], None, [msg])) for t in sorted(lost)]
+
+    def abort(self):
+        """Drop pending jobs and stop the workers"""
+        self.aborted = True
+        self.pool.terminate()
+
+    def close(self):
+        """Wait for the workers to exit.  A pool that lost jobs would wait
+        on them forever, so it is stopped instead."""
+        if self.lost and not self.aborted:
+            self.abort()
+        if not self.aborted:
+            self.pool.close()
+        self.pool.join()
+
+
+def translate_file(job, reasons):
+    """Translates the XML file of a job, writing its JSON unless the job
+    says otherwise.  Pipelined shells and the facet ranges of split shells
+    are returned."""
+    path = job['path']
+    try:
+        if job.get('stream'):
+            # streaming translators parse the file themselves
+            span = job.get('span')
+            data = job['translator'](path, *(span and [span] or []))
+        else:
             tree = parse_xml(path)
-            if not tree:
-                reason = "Unable to parse XML file '{}'.".format(path)
-                self.report_exception(job, reason)
-                continue
-            root = tree.getroot()
+            data = tree and job['translator'](tree.getroot())
+    except Exception as e:
+        reasons.append("Translation failure: '{}'.".format(e))
+        return None
+    if data is None:
+        reasons.append("Unable to parse XML file '{}'.".format(path))
+        return None
+    if 'part' in job:
+        return data
+    summary = shell_summary(job, data)
+    write_json(job, data, reasons)
+    return summary
+
+
+def merge_shell(job, reasons):
+    """Joins the translated facet ranges of a split shell"""
+    parts = job.pop('data')
+    stats = [p.pop('vertexCache') for p in parts if 'vertexCache' in p]
+    lods = merge_lods(parts) if 'lods' in parts[0] else None
+    data = merge_shells(parts)
+    if lods:
+        data['lods'] = lods
+    if stats:
+        data['vertexCache'] = [sum(x) for x in zip(*stats)]
+    summary = shell_summary(job, data)
+    write_json(job, data, reasons)
+    return summary
+
+
+def write_json(job, data, reasons):
+    """Output the JSON of a translated file and of its levels of detail,
+    unless the job says otherwise"""
+    if not job.get('write', True):
+        return
+    out_path = os.path.splitext(job['path'])[0] + ".json"
+    lods = data.pop('lods', [])
+    outputs = [(out_path, data)]
+    outputs.extend((lod_name(out_path, level), lod)
+                   for level, lod in enumerate(lods, 1))
+    for path, output in outputs:
+        try:
+            with OutputFile(path) as f:
+                json.dump(output, f)
+        except Exception as e:
+            reasons.append("Unable to output JSON '{}': {}.".format(path, e))
+    remove_lods(out_path, len(lods))
+    if lods:
+        data['lods'] = lods
+
+
+def written_level(path, name, level):
+    """The coarsest level of detail written of a shell file, up to level"""
+    while level and not os.path.isfile(join(path, lod_name(name, level))):
+        level -= 1
+    return level
+
+
+def batch_files(job, reasons):
+    """Batches the shell JSON files of a job, and their levels of detail.  A
+    shell short of a level is batched at its coarsest one."""
+    for level in xrange(job['lods'] + 1):
+        batch = new_batch(batch_reindex(job))
+        for s in job['shells']:
+            name = lod_name(s, written_level(job['path'], s, level))
             try:
-                data = job['translator'](root)
+                with open(join(job['path'], name)) as f:
+                    shell = json.load(f)
+                if level:
+                    shell.setdefault('error', 0.0)
+                shell['id'] = SHELL_REGEX.match(s).group(1)
+                add_to_batch(batch, shell)
             except Exception as e:
-                reason = "Translation failure: '{}'.".format(e)
-                self.report_exception(job, reason)
+                msg = "Error batching shell '{}': {}"
+                reasons.append(msg.format(name, e))
+                continue
+        write_batch(job, finish_batch(batch), reasons, level)
+    remove_batch_lods(job)
+
+
+def assemble_batch(job, reasons):
+    """Batches the spooled shells of a job, and their levels of detail, in
+    the planned order.  A shell short of a level is batched at its
+    coarsest one.  Shells that failed to translate were reported
+    already."""
+    shells = {}
+    for s, path in job.pop('data').items():
+        if path is None:
+            continue
+        try:
+            shells[s] = unspool_shell(path)
+        except Exception as e:
+            reasons.append("Error unspooling shell '{}': {}".format(s, e))
+    levels = [shells] + [{} for _ in xrange(job['lods'])]
+    for s, shell in shells.items():
+        lods = shell.pop('lods', []) or [dict(shell, error=0.0)]
+        for level in xrange(1, job['lods'] + 1):
+            # copied, as batching takes the values of each
+            levels[level][s] = dict(lods[min(level, len(lods)) - 1])
+    for level, level_shells in enumerate(levels):
+        batch = new_batch(batch_reindex(job))
+        for s in job['shells']:
+            shell = level_shells.get(s)
+            if shell is None:
                 continue
-            out_path = os.path.splitext(path)[0] + ".json"
             try:
-                with open(out_path, "w") as f:
-                    json.dump(data, f)
+                shell['id'] = SHELL_REGEX.match(s).group(1)
+                add_to_batch(batch, shell)
             except Exception as e:
-                reason = "Unable to output JSON '{}': {}.".format(out_path, e)
-                self.report_exception(job, reason)
+                msg = "Error batching shell '{}': {}"
+                reasons.append(msg.format(lod_name(s, level), e))
+        write_batch(job, finish_batch(batch), reasons, level)
+    remove_batch_lods(job)
+
+
+def remove_batch_lods(job):
+    """Remove the levels of detail of a batch that are no longer written"""
+    extension = job['use_tyson'] and ".tyson" or ".json"
+    remove_lods(join(job['path'], job['name']), job['lods'],
+                (extension, ".manifest.json"))
+
+
+def write_batch(job, batch, reasons, level=0):
+    """Output a batch, or one of its levels of detail, and its manifest"""
+    use_tyson = job['use_tyson']
+    extension = use_tyson and ".tyson" or ".json"
+    name = lod_name(job['name'], level)
+
+    out_path = join(job['path'], name + extension)
+    try:
+        with OutputFile(out_path) as f:
+            if use_tyson:
+                TysonEncoder().encode(batch, f, delta=CONFIG['deltaArrays'])
+                # Must add padding for now to avoid a chrome bug
+                f_size = f.tell()
+                for i in range(0, 8 - (f_size % 8)):
+                    f.write(chr(0))
+            else:
+                members, shells = dump_batch(batch, f)
+        if use_tyson:
+            members, shells = tyson_spans(out_path)
+    except Exception as e:
+        reasons.append("Unable to output JSON '{}': {}.".format(out_path, e))
+        return
+    # write manifest
+    manifest = batch_manifest(batch, members, shells, job['bboxes'])
+    manifest['batch'] = os.path.basename(out_path)
+    manifest_path = join(job['path'], name + ".manifest.json")
+    try:
+        with OutputFile(manifest_path) as f:
+            json.dump(manifest, f)
+    except Exception as e:
+        reasons.append("Unable to output manifest '{}': {}.".format(
+            manifest_path, e))
 
 
 class XMLTranslator(object):
     """Translates STEP XML files to JSON"""
 
-    def __init__(self, batches=None, reindex=None, use_tyson=None):
+    def __init__(self, batches=None, reindex=None, use_tyson=None,
+                 use_cache=None, pipeline=None, keep_shells=None,
+                 fail_fast=None, batch_bytes=None, spatial=None,
+                 dedupe=None):
         self.batches = batches
+        self.batch_bytes = batch_bytes
+        self.spatial = spatial
+        self.dedupe = dedupe
+        self.world = {}
         self.reindex = reindex
         self.use_tyson = use_tyson
+        self.use_cache = use_cache
+        self.pipeline = pipeline
+        self.keep_shells = keep_shells
+        self.fail_fast = fail_fast
+        self.cache = None
+        self.digests = None
+        self.scheduler = None
+        self.index = None
+        self.summaries = {}
         self.parser = None
-
-    @staticmethod
-    def assign(batches, shell):
-        """simple bin packing"""
-        name, size = shell
-        blist = batches.values()
-        best = min([x['total_size'] for x in blist])
-        selected = [x for x in blist if x['total_size'] == best][0]
-        selected['total_size'] += size
-        selected['shells'].append(name)
+        self.spool = None
 
     def get_batches(self, shells):
-        """assign shells to batches, leveling by size"""
+        """assign shells to batches, leveling by size.  Largest shells are
+        placed first, each into the batch holding the least so far"""
+        count = self.batches
+        if self.batch_bytes:
+            total = sum(size for _, size in shells)
+            count = -(-total // self.batch_bytes)
+            count = max(1, min(len(shells), count))
         batches = {'batch%s' % i:  {'total_size': 0, 'shells': []}
-                   for i in xrange(self.batches)}
+                   for i in xrange(count)}
+        if self.spatial:
+            return self.spatial_batches(batches, shells)
+        heap = [(0, i) for i in xrange(count)]
+        for name, size in sorted(shells, key=itemgetter(1), reverse=True):
+            total, i = heap[0]
+            batch = batches['batch%s' % i]
+            batch['total_size'] += size
+            batch['shells'].append(name)
+            heapq.heapreplace(heap, (total + size, i))
+        return batches
+
+    def spatial_batches(self, batches, shells):
+        """Cut the shells, in Morton order of their world bounding boxes,
+        into consecutive runs of about equal size, one per batch"""
+        shell_id = lambda x: SHELL_REGEX.match(x).group(1)
+        bboxes = [self.world.get(shell_id(name)) for name, _ in shells]
+        ordered = sorted(zip(morton_codes(bboxes), shells))
+        total = max(1, sum(size for _, size in shells))
+        done = 0
+        for _, (name, size) in ordered:
+            i = int((done + size / 2.0) * len(batches) / total)
+            batch = batches['batch%s' % min(i, len(batches) - 1)]
+            batch['total_size'] += size
+            batch['shells'].append(name)
+            done += size
+        return batches
+
+    def batch_bbox(self, batch):
+        """World-space bounding box of a batch's shells, None if unknown"""
+        shell_id = lambda x: SHELL_REGEX.match(x).group(1)
+        bboxes = [self.world[shell_id(x)] for x in batch['shells']
+                  if shell_id(x) in self.world]
+        return union_bbox(bboxes) if bboxes else None
+
+    def shell_bboxes(self, shells):
+        """Bounding boxes of the external shells, by the id in their file
+        name.  Also settles their world-space ones."""
+        world = world_bboxes(self.index)
+        bboxes = {}
         for shell in shells:
-            self.assign(batches, shell)
+            match = SHELL_REGEX.match(os.path.basename(shell['href']))
+            if match:
+                bboxes[match.group(1)] = shell['bbox']
+                self.world[match.group(1)] = world.get(shell['id'],
+                                                       shell['bbox'])
+        return bboxes
+
+    def plan_batches(self, shells):
+        """Assign shells to batches, settling in the index the batch count,
+        when it follows from a byte target, and each batch's bbox"""
+        batches = self.get_batches(shells)
+        if len(batches) != self.batches:
+            self.batches = self.index['batches'] = len(batches)
+            LOG.debug("\tBatches: %s" % self.batches)
+        self.index['batchBboxes'] = [self.batch_bbox(batches['batch%s' % i])
+                                     for i in xrange(len(batches))]
+        self.write_index()
         return batches
 
-    def batch_shells(self, xml_dir):
+    def write_index(self):
+        """Output the index JSON, returning whether that failed"""
+        index_out, data = self.index_out, self.index
+        try:
+            with OutputFile(index_out) as f:
+                json.dump(data, f)
+        except Exception as e:
+            LOG.exception("Unable to write JSON file '{}'.".format(index_out))
+            return True
+        return False
+
+    def summarize(self, shells):
+        """Completes the shell summaries with those cached for shells that
+        were skipped as unchanged, and records them all for the cache"""
+        if self.cache is None:
+            return
+        cached = self.cache.get('shells', {})
+        self.digests['shells'] = {}
+        for shell in shells:
+            name = os.path.basename(shell['href'])
+            unchanged = (self.cache['files'].get(name) ==
+                         self.digests['files'].get(name))
+            if name not in self.summaries and unchanged and name in cached:
+                self.summaries[name] = cached[name]
+            if name in self.summaries:
+                self.digests['shells'][name] = self.summaries[name]
+
+    def report_cache(self):
+        """Log the average cache miss ratio, misses per facet, of drawing
+        the welded shells through the vertex cache"""
+        stats = [x['vertexCache'] for x in self.summaries.values()
+                 if 'vertexCache' in x]
+        if not stats:
+            return
+        facets, before, after = [sum(x) for x in zip(*stats)]
+        msg = "Vertex cache {}.  Facets: {} ACMR before: {:.3f} after: {:.3f}"
+        LOG.debug(msg.format(CONFIG['vertexCache'], facets,
+                             float(before) / max(facets, 1),
+                             float(after) / max(facets, 1)))
+
+    def dedupe_shells(self, xml_dir, shells):
+        """Keeps one of each set of external shells with the same geometry,
+        up to a translation.  Shapes place the kept shell instead of a
+        duplicate, through a child shape translating it into place, and
+        the files of duplicates are removed.  Returns the kept shells."""
+        name_of = lambda x: os.path.basename(x['href'])
+        groups = {}
+        for shell in shells:
+            summary = self.summaries.get(name_of(shell), {})
+            if 'geometry' in summary:
+                digest, start = summary['geometry']
+                groups.setdefault(digest, []).append((shell, start))
+        precision = CONFIG['roundPrecision']
+        duplicates = {}
+        for members in groups.values():
+            # only a shell whose output exists can be kept
+            stored = [x for x in members
+                      if os.path.isfile(join(xml_dir, x[0]['href']))]
+            if len(members) < 2 or not stored:
+                continue
+            kept, origin = stored[0]
+            for shell, start in members:
+                if shell is kept:
+                    continue
+                offset = [round(a - b, precision) if precision else a - b
+                          for a, b in zip(start, origin)]
+                duplicates[shell['id']] = (kept['id'], offset)
+                if self.digests is not None:
+                    self.digests['duplicates'][name_of(shell)] = name_of(kept)
+                for level in xrange(CONFIG['lodLevels'] + 1):
+                    remove_output(join(xml_dir, lod_name(shell['href'],
+                                                         level)))
+        if not duplicates:
+            return shells
+
+        instances = []
+        for shape in self.index['shapes']:
+            kept_shells = []
+            for sid in shape['shells']:
+                if sid not in duplicates:
+                    kept_shells.append(sid)
+                    continue
+                kept, offset = duplicates[sid]
+                if not any(offset) and kept not in (shape['shells'] +
+                                                    kept_shells):
+                    kept_shells.append(kept)
+                    continue
+                instance = "instance_" + sid
+                if instance not in [x['id'] for x in instances]:
+                    instances.append({'id': instance, 'shells': [kept],
+                                      'annotations': [], 'children': []})
+                xform = xform_matrix("I")
+                xform[12:15] = offset
+                shape['children'].append({
+                    'ref': instance,
+                    'xform': "I" if not any(offset) else xform
+                })
+            shape['shells'] = kept_shells
+        self.index['shapes'].extend(instances)
+        self.index['shells'] = [x for x in self.index['shells']
+                                if x['id'] not in duplicates]
+        moved = len([x for x in duplicates.values() if any(x[1])])
+        msg = "Duplicate shells: {} of {}, {} of them translated"
+        LOG.debug(msg.format(len(duplicates), len(shells), moved))
+        return [x for x in shells if x['id'] not in duplicates]
+
+    def finish_index(self, shells):
+        """Lists the levels of detail of each external shell in the index,
+        and writes it.  Returns whether that failed."""
+        if CONFIG['lodLevels']:
+            for shell in shells:
+                name = os.path.basename(shell['href'])
+                lods = self.summaries.get(name, {}).get('lods')
+                if lods:
+                    shell['lods'] = [
+                        dict(x, href=lod_name(shell['href'], level))
+                        for level, x in enumerate(lods, 1)]
+            self.index['lods'] = CONFIG['lodLevels']
+        return self.write_index()
+
+    def is_current(self, section, name, digest, paths):
+        """Whether outputs were last made from the inputs hashed to digest"""
+        extensions = [''] + sidecar_extensions()
+        return (self.cache[section].get(name) == digest and
+                all(os.path.isfile(x + e) for x in paths for e in extensions))
+
+    def batch_digest(self, shells, bboxes):
+        """Hash of a batch's member shells and the batching options"""
+        files = self.digests['files']
+        shell_id = lambda x: SHELL_REGEX.match(x).group(1)
+        members = [(x, files.get(x), bboxes.get(shell_id(x))) for x in shells]
+        if any(digest is None for _, digest, _ in members):
+            return None
+        key = [self.reindex, self.use_tyson, CONFIG['deltaArrays'], members]
+        return hashlib.sha1(json.dumps(key)).hexdigest()
+
+    def batch_jobs(self, xml_dir, batches, bboxes):
+        """Jobs for the planned batches, skipping those whose shells are
+        unchanged since the cached run"""
+        batch_extension = '.tyson' if self.use_tyson else '.json'
+        jobs = []
+        for batch, info in batches.items():
+            if self.cache is not None:
+                digest = self.batch_digest(info['shells'], bboxes)
+                outputs = []
+                for level in xrange(CONFIG['lodLevels'] + 1):
+                    name = join(xml_dir, lod_name(batch, level))
+                    outputs.extend([name + batch_extension,
+                                    name + ".manifest.json"])
+                if digest:
+                    self.digests['batches'][batch] = digest
+                if digest and self.is_current('batches', batch, digest,
+                                              outputs):
+                    continue
+            jobs.append({'path': xml_dir, 'name': batch,
+                         'shells': info['shells'],
+                         'reindex': self.reindex,
+                         'use_tyson': self.use_tyson,
+                         'lods': CONFIG['lodLevels'],
+                         'bboxes': bboxes})
+        if self.cache is not None:
+            msg = "Batches unchanged: {} of {}"
+            LOG.debug(msg.format(len(batches) - len(jobs), len(batches)))
+        return jobs
+
+    def report(self, job, reasons):
+        """Log the errors of a finished job, returning whether there were
+        any.  Failed work is left out of the cache, to be redone."""
+        for reason in reasons:
+            msg = "Error processing '{}': {}"
+            LOG.error(msg.format(job['path'], reason))
+        if reasons and self.digests is not None:
+            if 'type' in job:
+                name = os.path.splitext(os.path.basename(job['path']))[0]
+                self.digests['files'].pop(name + ".json", None)
+            batch = job.get('batch', job.get('name'))
+            self.digests['batches'].pop(batch, None)
+        if reasons and self.fail_fast:
+            LOG.error("Stopping at the first failure.")
+            self.scheduler.abort()
+        return bool(reasons)
+
+    def report_batches(self, xml_dir, batches, shells):
+        """Log batching statistics"""
+        if self.batch_bytes:
+            LOG.debug("Batch target: {} bytes.".format(self.batch_bytes))
+        sz = [x['total_size'] for x in batches.values()]
+        LOG.debug("Batch balance, planned.  " + balance(sz))
+        c = [len(x['shells']) for x in batches.values()]
+        LOG.debug("Batch balance, shells.  " + balance(c))
+        shells_size = sum([size for name, size in shells])
+        msg = "Shells.  Count: {} Total Size: {} bytes."
+        LOG.debug(msg.format(len(shells), shells_size))
+        batch_extension = '.tyson' if self.use_tyson else '.json'
+        size_of = lambda x: os.path.getsize(join(xml_dir, x))
+        sizes = [size_of(x + batch_extension) for x in batches.keys()]
+        LOG.debug("Batch balance, output.  " + balance(sizes))
+        batches_size = sum(sizes)
+        msg = "Batches.  Count: {} Total Size: {} bytes."
+        LOG.debug(msg.format(len(sizes), batches_size))
+        compression = float(batches_size) / float(shells_size)
+        msg = "Compression: {}".format(compression)
+        for encoding in CONFIG['sidecars']:
+            extension = batch_extension + SIDECARS[encoding][0]
+            size = sum(size_of(x + extension) for x in batches.keys())
+            msg += "  {}: {} bytes, {:.3f} of the batches".format(
+                encoding, size, float(size) / batches_size)
+        LOG.debug(msg)
+
+    def batch_shells(self, xml_dir, bboxes=None):
         """Generates batched shell files"""
-        is_shell = lambda x: SHELL_REGEX.match(x)
+        is_shell = lambda x: SHELL_REGEX.match(x) and not LOD_REGEX.search(x)
         size_of = lambda x: os.path.getsize(join(xml_dir, x))
         shells = [(x, size_of(x)) for x in os.listdir(xml_dir) if is_shell(x)]
-        shells.sort(key=itemgetter(1), reverse=True)
-        batches = self.get_batches(shells)
-
-        # start workers and queue jobs
-        queue = Queue()
-        exceptions = Queue()
-        count = min(cpu_count(), self.batches)
-        workers = [BatchWorker(queue, exceptions) for _ in xrange(count)]
-        for w in workers:
-            w.start()
+        batches = self.plan_batches(shells)
+        jobs = self.batch_jobs(xml_dir, batches, bboxes or {})
+        for job in jobs:
+            self.scheduler.submit(batch_files, job)
+
+        has_errors = False
+        for job, _, reasons in self.scheduler.results():
+            has_errors = self.report(job, reasons) or has_errors
+        if not has_errors:
+            self.report_batches(xml_dir, batches, shells)
 
-        # enqueue jobs
-        for batch, info in batches.items():
-            job = {'path': xml_dir, 'name': batch, 'shells': info['shells'],
-                   'reindex': self.reindex,
-                   'use_tyson': self.use_tyson}
-            queue.put(job)
-
-        # add worker termination cues
-        for _ in workers:
-            queue.put(None)
-
-        # wait for completion
-        while any([x.is_alive() for x in workers]):
-            time.sleep(1)
-
-        # report errors, if any
-        has_errors = not exceptions.empty()
-        while not exceptions.empty():
-            info = exceptions.get()
-            msg = "Error processing '{}': {}"
-            LOG.error(msg.format(info['path'], info['reason']))
+        return has_errors
 
-        if not has_errors:
-            # report statistics
-            msg = "Batch sizes.  Smallest: {} Largest: {} Avg: {}"
-            sz = [x['total_size'] for x in batches.values()]
-            LOG.debug(msg.format(min(sz), max(sz), sum(sz) / len(batches)))
-            c = [len(x['shells']) for x in batches.values()]
-            msg = "Batch shells.  Smallest: {} Largest: {} Avg: {}"
-            LOG.debug(msg.format(min(c), max(c), sum(c) / len(batches)))
-            shells_size = sum([size for name, size in shells])
-            msg = "Shells.  Count: {} Total Size: {} bytes."
-            LOG.debug(msg.format(len(shells), shells_size))
-            batch_extension = '.tyson' if self.use_tyson else '.json'
-            sizes = [size_of(x + batch_extension) for x in batches.keys()]
-            batches_size = sum(sizes)
-            msg = "Batches.  Count: {} Total Size: {} bytes."
-            LOG.debug(msg.format(len(sizes), batches_size))
-            compression = float(batches_size) / float(shells_size)
-            LOG.debug("Compression: {}".format(compression))
+    def plan_pipeline(self, xml_dir, jobs, bboxes):
+        """Plans the batches before translation, from the sizes of the shell
+        XML, and marks each shell's job with its batch and the spool
+        directory it goes through.  Returns the batches and their sizing, and
+        the batch jobs."""
+        shell_jobs = dict((x['shell'], x) for x in jobs if 'shell' in x)
+        shells = [(x['shell'], x['bytes']) for x in jobs if 'shell' in x]
+        batches = self.plan_batches(shells)
+        batch_jobs = self.batch_jobs(xml_dir, batches, bboxes)
+        self.spool = tempfile.mkdtemp(prefix="xmlToJson.spool.")
+        for job in batch_jobs:
+            for s in job['shells']:
+                shell_jobs[s].update(batch=job['name'], spool=self.spool,
+                                     write=bool(self.keep_shells))
+        return batches, shells, batch_jobs
 
+    @staticmethod
+    def split_job(job):
+        """Divides the job of a shell with more facets or bytes than
+        configured into jobs for consecutive spans of its facets, each
+        parsing only the head of the file and its own span"""
+        facets = job.get('size', 0)
+        if not job.get('stream') or not facets:
+            return [job]
+        parts = 1
+        for key, amount in (('splitFacets', facets),
+                            ('splitBytes', job['bytes'])):
+            if CONFIG[key]:
+                parts = max(parts, -(-amount // CONFIG[key]))
+        spans = facet_spans(job['path'], min(parts, facets))
+        if not spans or len(spans) < 2:
+            return [job]
+        return [dict(job, part=i, parts=len(spans), span=span,
+                     bytes=job['bytes'] / len(spans))
+                for i, span in enumerate(spans)]
+
+    def translate_files(self, xml_dir, jobs, bboxes):
+        """Translates the external files, and when pipelining, batches each
+        planned batch as soon as its shells are translated"""
+        for job in jobs:
+            path = job['path']
+            job['bytes'] = os.path.getsize(path) if os.path.isfile(path) else 0
+        pipeline = self.pipeline and self.batches
+        if pipeline:
+            batches, shells, batch_jobs = self.plan_pipeline(
+                xml_dir, jobs, bboxes)
+            # shells of unchanged batches need no translation
+            jobs = [x for x in jobs if 'shell' not in x or 'batch' in x]
+            planned = dict((x['name'], x) for x in batch_jobs)
+            arrived = dict((x['name'], {}) for x in batch_jobs)
+
+        # skip files translated from the same source and settings before
+        todo = []
+        for job in jobs:
+            if self.cache is not None and 'batch' not in job:
+                out_path = os.path.splitext(job['path'])[0] + ".json"
+                name = os.path.basename(out_path)
+                digest = self.digests['files'].get(name)
+                levels = 0
+                if 'shell' in job:
+                    # a shell may have left out some levels of detail
+                    summary = self.cache.get('shells', {}).get(name)
+                    levels = (CONFIG['lodLevels'] if summary is None else
+                              len(summary.get('lods', [])))
+                outputs = [lod_name(out_path, level)
+                           for level in xrange(levels + 1)]
+                # duplicates have no output of their own
+                kept = self.cache.get('duplicates', {}).get(name)
+                if self.dedupe and kept and self.is_current(
+                        'files', kept, self.digests['files'].get(kept), []):
+                    outputs = []
+                if self.is_current('files', name, digest, outputs):
+                    continue
+            todo.append(job)
+        if self.cache is not None:
+            msg = "Files skipped: {} of {}"
+            LOG.debug(msg.format(len(jobs) - len(todo), len(jobs)))
+
+        # split giant shells, then start the largest jobs first so that no
+        # big one is left running alone at the end
+        whole = {}
+        tasks = []
+        for job in todo:
+            parts = self.split_job(job)
+            if len(parts) > 1:
+                whole[job['path']] = (job, {})
+            tasks.extend(parts)
+        if whole:
+            msg = "Split shells: {} into {} jobs"
+            LOG.debug(msg.format(len(whole), len(tasks) - len(todo) +
+                                 len(whole)))
+        tasks.sort(key=itemgetter('bytes'), reverse=True)
+        for job in tasks:
+            self.scheduler.submit(translate_file, job)
+
+        has_errors = False
+        for job, result, reasons in self.scheduler.results():
+            has_errors = self.report(job, reasons) or has_errors
+            if 'part' in job:
+                # merge once every range of the shell is translated
+                shell_job, done = whole[job['path']]
+                done[job['part']] = result
+                if len(done) < job['parts']:
+                    continue
+                del whole[job['path']]
+                data = [done[i] for i in xrange(len(done))]
+                job = shell_job
+                if None not in data:
+                    self.scheduler.submit(merge_shell, dict(job, data=data))
+                    continue
+                result = None
+            if 'shell' in job and result is not None:
+                # a pipelined shell goes on to its batch, by its spool file
+                result = dict(result)
+                shell = result.pop('shell', None)
+                self.summaries[job['shell']] = result
+                result = shell
+            if 'batch' in job:
+                name = job['batch']
+                arrived[name][job['shell']] = result
+                if len(arrived[name]) == len(planned[name]['shells']):
+                    job = dict(planned[name], data=arrived.pop(name))
+                    self.scheduler.submit(assemble_batch, job)
+        if pipeline and not has_errors:
+            self.report_batches(xml_dir, batches, shells)
         return has_errors
 
     def translate(self, xml_dir, xml_index):
@@ -486,7 +2205,11 @@ class XMLTranslator(object):
         LOG.debug("\tShells: %s" % len(data.get('shells', [])))
         num_shells = len(external_shells)
         LOG.debug("\tExternal Shells: %s" % num_shells)
-        if self.batches and num_shells:
+        if self.batch_bytes and num_shells:
+            # the count follows from the shell sizes, once they are known
+            self.batches = 1
+            data['batches'] = self.batches
+        elif self.batches and num_shells:
             if num_shells < self.batches:
                 self.batches = 1
             LOG.debug("\tBatches: %s" % self.batches)
@@ -494,55 +2217,74 @@ class XMLTranslator(object):
         else:
             self.batches = 0
 
-        try:
-            with open(index_out, "w") as f:
-                json.dump(data, f)
-        except Exception as e:
-            LOG.exception("Unable to write JSON file '{}'.".format(index_out))
+        if self.dedupe and self.pipeline:
+            LOG.warning("Duplicate shells are found after translation, "
+                        "batching afterwards instead of pipelining.")
+            self.pipeline = False
+        self.index_out, self.index = index_out, data
+        if self.write_index():
             return True
 
-        # start workers and queue jobs
-        queue = Queue()
-        exceptions = Queue()
-        count = cpu_count()
-        workers = [TranslationWorker(queue, exceptions) for _ in xrange(count)]
-        for w in workers:
-            w.start()
-
         xml_path = lambda p: join(xml_dir, os.path.splitext(p)[0] + ".xml")
+        jobs = []
         for annotation in external_annotations:
-            queue.put({
+            jobs.append({
                 'type': "annotation",
                 'path': xml_path(annotation['href']),
                 'translator': translate_annotation
             })
 
+        stream = CONFIG['streamShells']
         for shell in external_shells:
-            queue.put({
+            path = xml_path(shell['href'])
+            jobs.append({
                 'type': "shell",
-                'path': xml_path(shell['href']),
-                'translator': translate_shell
+                'path': path,
+                'size': shell['size'],
+                'shell': os.path.basename(os.path.splitext(path)[0]) + ".json",
+                'translator': stream and stream_shell or translate_shell_file,
+                'stream': stream,
+                'dedupe': self.dedupe
             })
-
-        # add worker termination cues
-        for _ in workers:
-            queue.put(None)
-
-        # wait for completion
-        while any([x.is_alive() for x in workers]):
-            time.sleep(1)
-
-        # report errors, if any
-        has_errors = not exceptions.empty()
-        while not exceptions.empty():
-            info = exceptions.get()
-            msg = "Error processing '{}': {}"
-            LOG.error(msg.format(info['path'], info['reason']))
-
-        if has_errors or not self.batches:
-            return has_errors
-
-        return self.batch_shells(xml_dir)
+        bboxes = self.shell_bboxes(external_shells)
+
+        # hash the sources of cached runs
+        cache_path = join(xml_dir, CACHE_FILE)
+        if self.use_cache:
+            self.cache = load_cache(xml_dir)
+            self.digests = {'files': {}, 'batches': {}, 'duplicates': {}}
+            for job in jobs:
+                if os.path.isfile(job['path']):
+                    name = os.path.splitext(job['path'])[0] + ".json"
+                    name = os.path.basename(name)
+                    self.digests['files'][name] = file_digest(job['path'])
+        elif os.path.isfile(cache_path):
+            # outputs are about to be rewritten behind the cache's back
+            os.remove(cache_path)
+
+        # one pool of workers serves every stage
+        self.scheduler = Scheduler(cpu_count(), self.fail_fast)
+        try:
+            has_errors = self.translate_files(xml_dir, jobs, bboxes)
+            self.summarize(external_shells)
+            self.report_cache()
+            if self.dedupe and not has_errors:
+                external_shells = self.dedupe_shells(xml_dir, external_shells)
+                bboxes = self.shell_bboxes(external_shells)
+                if len(external_shells) < self.batches:
+                    self.batches = self.index['batches'] = 1
+            if not has_errors and self.batches and not self.pipeline:
+                has_errors = self.batch_shells(xml_dir, bboxes)
+        finally:
+            self.scheduler.close()
+            if self.spool:
+                shutil.rmtree(self.spool, True)
+                self.spool = None
+        if (CONFIG['lodLevels'] or self.dedupe) and external_shells:
+            has_errors = self.finish_index(external_shells) or has_errors
+        if self.digests is not None:
+            save_cache(xml_dir, self.digests)
+        return has_errors
 
 #------------------------------------------------------------------------------
 
@@ -552,16 +2294,67 @@ if __name__ == "__main__":
         description="Translates STEP XML to JSON")
     parser.add_argument("dir", help="directory containing STEP XML")
     parser.add_argument("index", help="index file")
+    batching = parser.add_mutually_exclusive_group()
     h = "create batches of shells"
-    parser.add_argument("-b", "--batches", type=int, default=0, help=h)
+    batching.add_argument("-b", "--batches", type=int, default=0, help=h)
+    h = "create batches of shells of about this size, e.g. 4MB"
+    batching.add_argument("-B", "--batch-bytes", type=parse_bytes, help=h)
+    h = "batch shells that are near each other"
+    parser.add_argument("-s", "--spatial", action="store_true", help=h)
     h = "re-index when batching shells"
     parser.add_argument("-r", "--reindex", action="store_true", help=h)
     h = "output TySON instead of JSON"
     parser.add_argument("-t", "--tyson", action="store_true", help=h)
+    h = "skip files unchanged since the last cached run"
+    parser.add_argument("-c", "--cache", action="store_true", help=h)
+    h = "batch shells as they are translated, without per-shell JSON"
+    parser.add_argument("-p", "--pipeline", action="store_true", help=h)
+    h = "also write per-shell JSON when pipelining"
+    parser.add_argument("-k", "--keep-shells", action="store_true", help=h)
+    h = "write shells as welded vertices and facet indices"
+    parser.add_argument("-w", "--weld", action="store_true", help=h)
+    h = "order welded shells for the GPU vertex cache"
+    parser.add_argument("-o", "--optimize", action="store_true", help=h)
+    h = "quantize points to integers of this many bits in their bounding box"
+    parser.add_argument("-q", "--quantize", type=int, default=0, help=h)
+    h = "encode normals as octahedral pairs of 8 or 16 bit integers"
+    parser.add_argument("-n", "--normals", type=int, choices=(8, 16),
+                        help=h)
+    h = "delta code the integer arrays of TySON batches"
+    parser.add_argument("-z", "--delta", action="store_true", help=h)
+    h = "also write a compressed copy of every output in this encoding"
+    parser.add_argument("-g", "--sidecar", action="append", default=[],
+                        choices=sorted(SIDECARS), help=h)
+    h = "compression level of the copies, 1 to 9"
+    parser.add_argument("-G", "--sidecar-level", type=int, default=9,
+                        choices=range(1, 10), metavar="LEVEL", help=h)
+    h = "also write up to 3 simplified levels of detail of each shell"
+    parser.add_argument("-l", "--lods", type=int, default=0, help=h)
+    h = "store shells that repeat, even moved, once and place copies of it"
+    parser.add_argument("-d", "--dedupe", action="store_true", help=h)
+    h = "stop at the first failure"
+    parser.add_argument("-x", "--fail-fast", action="store_true", help=h)
     args = parser.parse_args()
-
+    if args.quantize and not 2 <= args.quantize <= 31:
+        parser.error("quantized points need 2 to 31 bits")
+
+    CONFIG['lodLevels'] = max(0, min(args.lods, len(CONFIG['lodCells'])))
+    CONFIG['weldVertices'] = args.weld
+    CONFIG['optimizeCache'] = args.optimize
+    CONFIG['quantizeBits'] = args.quantize
+    CONFIG['octNormals'] = args.normals or 0
+    CONFIG['deltaArrays'] = args.delta
+    CONFIG['sidecars'] = sorted(set(args.sidecar))
+    CONFIG['sidecarLevel'] = args.sidecar_level
+    if args.delta and not args.tyson:
+        LOG.warning("Only TySON batches (-t) are delta coded.")
+    if args.optimize and not args.weld:
+        LOG.warning("Only welded shells (-w) are ordered for the cache.")
     start_time = datetime.now()
-    translator = XMLTranslator(args.batches, args.reindex, args.tyson)
+    translator = XMLTranslator(args.batches, args.reindex, args.tyson,
+                               args.cache, args.pipeline, args.keep_shells,
+                               args.fail_fast, args.batch_bytes,
+                               args.spatial, args.dedupe)
     errors_in_translation = translator.translate(args.dir, args.index)
     dt = datetime.now() - start_time
     LOG.info("xmlToJson Elapsed time: {} secs".format(dt.seconds))
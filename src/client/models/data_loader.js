@@ -204,7 +204,7 @@ export default class DataLoader extends THREE.EventDispatcher {
                     data = event.data.data;
                     // Remove the reference to the shell
                     delete this._shells[event.data.id];
-                    shell.addGeometry(data.position, data.normals, data.colors);
+                    shell.addGeometry(data.position, data.normals, data.colors, data.index);
                     this.dispatchEvent({ type: "shellLoad", file: event.data.file });
                 }
                 break;
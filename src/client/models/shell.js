@@ -33,13 +33,21 @@ export default class Shell extends THREE.EventDispatcher {
         return this._id;
     }
 
-    addGeometry(position, normals, colors) {
+    addGeometry(position, normals, colors, index) {
         this.dispatchEvent({type: "shellStartLoad", shell: this});
         // Create the geometry to hold the data
         this._geometry = new THREE.BufferGeometry();
-        this._geometry.addAttribute('position', new THREE.BufferAttribute(this._size * 3, 3));
-        this._geometry.addAttribute('normal',   new THREE.BufferAttribute(this._size * 3, 3));
-        this._geometry.addAttribute('color',    new THREE.BufferAttribute(this._size * 3, 3));
+        if (index) {
+            // Welded vertices, drawn through the facet index with drawElements
+            this._geometry.addAttribute('position', new THREE.BufferAttribute(position, 3));
+            this._geometry.addAttribute('normal',   new THREE.BufferAttribute(normals, 3));
+            this._geometry.addAttribute('color',    new THREE.BufferAttribute(colors, 3));
+            this._geometry.setIndex(new THREE.BufferAttribute(index, 1));
+        } else {
+            this._geometry.addAttribute('position', new THREE.BufferAttribute(this._size * 3, 3));
+            this._geometry.addAttribute('normal',   new THREE.BufferAttribute(this._size * 3, 3));
+            this._geometry.addAttribute('color',    new THREE.BufferAttribute(this._size * 3, 3));
+        }
 
         // Setup the offsets
         let chunkSize = 21845;
@@ -56,9 +64,11 @@ export default class Shell extends THREE.EventDispatcher {
         }
 
         // Now load the rest of the data
-        this._geometry.attributes.position.array = position;
-        this._geometry.attributes.normal.array = normals;
-        this._geometry.attributes.color.array = colors;
+        if (!index) {
+            this._geometry.attributes.position.array = position;
+            this._geometry.attributes.normal.array = normals;
+            this._geometry.attributes.color.array = colors;
+        }
         // Compute bbox
         this._geometry.computeBoundingBox();
         this._boundingBox = this._geometry.boundingBox.clone();
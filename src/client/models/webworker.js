@@ -481,6 +481,7 @@ var TYSON = (function () {
 
     var TYSON = function TYSON (buffer) {
         var view = new DataView(buffer);
+        var bytesU8 = new Uint8Array(buffer);
         var values = [];
         var imports = {
             pushNull:function () {
@@ -539,35 +540,62 @@ var TYSON = (function () {
             newTypedArray:function (count, arrayType){
                 var start = core.getPos();
                 var bytes = 1;
+                var valueArray;
+                var i, j;
+                // Pick the element reader once, then run a tight loop
                 switch (arrayType) {
                     case 66:  // $B
                         bytes = 1;
+                        valueArray = [];
+                        for (i = 0, j = start; i < count; i++, j += bytes) {
+                            valueArray[i] = view.getInt8(j);
+                        }
                         break;
                     case 105: // $i
                         bytes = 2;
+                        valueArray = [];
+                        for (i = 0, j = start; i < count; i++, j += bytes) {
+                            valueArray[i] = view.getInt16(j);
+                        }
                         break;
                     case 73:  // $I
                         bytes = 4;
-                        break;
-                }
-                var stop = start + count * bytes;
-                var valueArray = [];
-                var i, j;
-                for (i = 0, j = start; i < count; i++, j += bytes) {
-                    switch (bytes) {
-                        case 1:  // $B
-                            valueArray[i] = view.getInt8(j);
-                            break;
-                        case 2: // $i
-                            valueArray[i] = view.getInt16(j);
-                            break;
-                        case 4:  // $I
+                        valueArray = [];
+                        for (i = 0, j = start; i < count; i++, j += bytes) {
                             valueArray[i] = view.getInt32(j);
-                            break;
-                    }
+                        }
+                        break;
+                    case 76:  // $L
+                        bytes = 8;
+                        valueArray = [];
+                        for (i = 0, j = start; i < count; i++, j += bytes) {
+                            valueArray[i] = view.getInt32(j) * 4294967296 + view.getUint32(j + 4);
+                        }
+                        break;
+                    case 100: // $d
+                        bytes = 4;
+                        valueArray = new Float32Array(count);
+                        for (i = 0, j = start; i < count; i++, j += bytes) {
+                            valueArray[i] = view.getFloat32(j);
+                        }
+                        break;
+                    case 68:  // $D
+                        bytes = 8;
+                        valueArray = new Float64Array(count);
+                        for (i = 0, j = start; i < count; i++, j += bytes) {
+                            valueArray[i] = view.getFloat64(j);
+                        }
+                        break;
+                    case 88:  // $X
+                        // a plain array like the other integer arrays, as
+                        // shell values are scaled in place once decoded
+                        valueArray = new Array(count);
+                        core.setPos(decodeDeltas(valueArray, start));
+                        values.push(valueArray);
+                        return;
                 }
                 values.push(valueArray);
-                core.setPos(stop);
+                core.setPos(start + count * bytes);
             },
             newArray:function (count) {
                 var val = [];
@@ -579,6 +607,42 @@ var TYSON = (function () {
             }
 
         };
+        // Delta coded integer arrays hold the differences between consecutive
+        // values, as int8, int16 or zigzag LEB128 varints. Returns the end.
+        function decodeDeltas (valueArray, start) {
+            var count = valueArray.length;
+            var value = 0;
+            var i, j;
+            switch (bytesU8[start]) {
+                case 66:  // $B
+                    for (i = 0, j = start + 1; i < count; i++, j++) {
+                        value += view.getInt8(j);
+                        valueArray[i] = value;
+                    }
+                    return j;
+                case 105: // $i
+                    for (i = 0, j = start + 1; i < count; i++, j += 2) {
+                        value += view.getInt16(j);
+                        valueArray[i] = value;
+                    }
+                    return j;
+                case 86:  // $V
+                    j = start + 5;
+                    for (i = 0; i < count; i++) {
+                        var byte = bytesU8[j++];
+                        var zigzag = byte & 0x7F;
+                        for (var shift = 7; byte & 0x80; shift += 7) {
+                            byte = bytesU8[j++];
+                            zigzag |= (byte & 0x7F) << shift;
+                        }
+                        value = value + ((zigzag >>> 1) ^ -(zigzag & 1)) | 0;
+                        valueArray[i] = value;
+                    }
+                    return start + 5 + view.getUint32(start + 1);
+            }
+            throw Error("TYSON - Invalid delta coding: " + bytesU8[start]);
+        }
+
         var core = Core(imports, buffer);
 
         function decode () {
@@ -644,19 +708,74 @@ function processAnnotation(url, workerID, data) {
 /*********************************************************************/
 
 function unindexValues(data, buffers) {
-    var numValues = data.pointsIndex.length;
-    for (var i = 0; i < numValues; i++) {
-        buffers.position[i] = data.values[data.pointsIndex[i]];
-        buffers.normals[i] = data.values[data.normalsIndex[i]];
+    var numValues, i;
+    // Quantized points and octahedral normals are kept out of the value table
+    if (data.pointsIndex) {
+        numValues = data.pointsIndex.length;
+        for (i = 0; i < numValues; i++) {
+            buffers.position[i] = data.values[data.pointsIndex[i]];
+        }
+    }
+    if (data.normalsIndex) {
+        numValues = data.normalsIndex.length;
+        for (i = 0; i < numValues; i++) {
+            buffers.normals[i] = data.values[data.normalsIndex[i]];
+        }
+    }
+}
+
+function dequantizePoints(data, positionBuffer) {
+    // Quantized points are integers relative to the shell's bounding box
+    var scale = data.quantization.scale;
+    var offset = data.quantization.offset;
+    var length = data.points.length;
+    for (var i = 0; i < length; i += 3) {
+        positionBuffer[i] = data.points[i] * scale[0] + offset[0];
+        positionBuffer[i + 1] = data.points[i + 1] * scale[1] + offset[1];
+        positionBuffer[i + 2] = data.points[i + 2] * scale[2] + offset[2];
+    }
+}
+
+function octahedralNormal(normals, i, normalsBuffer, j, steps) {
+    // Unfold the octahedral normal at i onto the unit sphere, at j
+    var x = normals[i] / steps;
+    var y = normals[i + 1] / steps;
+    var z = 1 - Math.abs(x) - Math.abs(y);
+    var t = Math.max(-z, 0);
+    x += x >= 0 ? -t : t;
+    y += y >= 0 ? -t : t;
+    var length = Math.sqrt(x * x + y * y + z * z);
+    normalsBuffer[j] = x / length;
+    normalsBuffer[j + 1] = y / length;
+    normalsBuffer[j + 2] = z / length;
+}
+
+function unpackNormals(data, normalsBuffer) {
+    // Runs alternate between flat facets, with one normal, and facets with three
+    var steps = (1 << data.octahedral - 1) - 1;
+    var numRuns = data.flatFacets.length;
+    var i = 0, j = 0;
+    for (var run = 0; run < numRuns; run++) {
+        var flat = run % 2 === 0;
+        var facets = data.flatFacets[run];
+        for (var f = 0; f < facets; f++) {
+            for (var k = 0; k < 3; k++, j += 3) {
+                octahedralNormal(data.normals, flat ? i : i + k * 2, normalsBuffer, j, steps);
+            }
+            i += flat ? 2 : 6;
+        }
     }
 }
 
 function uncompressColors(data, colorsBuffer) {
     var index = 0;
     var numBlocks = data.colorsData.length;
+    // Per-facet durations cover all three vertices of each facet
+    var repeat = data.colorsPerFacet ? 3 : 1;
     for (var i = 0; i < numBlocks; i++) {
         var block = data.colorsData[i];
-        for (var j = 0; j < block.duration; j++) {
+        var duration = block.duration * repeat;
+        for (var j = 0; j < duration; j++) {
             colorsBuffer[index++] = block.data[0];
             colorsBuffer[index++] = block.data[1];
             colorsBuffer[index++] = block.data[2];
@@ -664,12 +783,54 @@ function uncompressColors(data, colorsBuffer) {
     }
 }
 
+function weldedBuffers(data) {
+    // Welded shells list each distinct vertex once, plus three vertex indices per facet
+    var length = data.points.length;
+    var vertices = length / 3;
+    var buffers = {
+        position: new Float32Array(length),
+        normals: new Float32Array(length),
+        colors: new Float32Array(length),
+        index: vertices > 65535 ? new Uint32Array(data.indices) : new Uint16Array(data.indices)
+    };
+    var factor = data.precision ? Math.pow(10, data.precision) : 1;
+    var i;
+    if (data.quantization) {
+        dequantizePoints(data, buffers.position);
+    } else {
+        for (i = 0; i < length; i++) {
+            buffers.position[i] = data.points[i] / factor;
+        }
+    }
+    if (data.octahedral) {
+        var steps = (1 << data.octahedral - 1) - 1;
+        for (i = 0; i < vertices; i++) {
+            octahedralNormal(data.normals, i * 2, buffers.normals, i * 3, steps);
+        }
+    } else {
+        for (i = 0; i < length; i++) {
+            buffers.normals[i] = data.normals[i] / factor;
+        }
+    }
+    if (data.colorsData) {
+        uncompressColors(data, buffers.colors);
+    } else {
+        buffers.colors.set(data.colors);
+    }
+    return buffers;
+}
+
 function processShellJSON(url, workerID, dataJSON, signalFinish) {
+    if (dataJSON.indices) {
+        postShell(url, workerID, dataJSON, weldedBuffers(dataJSON), signalFinish);
+        return;
+    }
     // Just copy the data into arrays
+    var numValues = dataJSON.quantization ? dataJSON.points.length : dataJSON.pointsIndex.length;
     var buffers = {
-        position: new Float32Array(dataJSON.pointsIndex.length),
-        normals: new Float32Array(dataJSON.pointsIndex.length),
-        colors: new Float32Array(dataJSON.pointsIndex.length)
+        position: new Float32Array(numValues),
+        normals: new Float32Array(numValues),
+        colors: new Float32Array(numValues)
     };
 
     if (dataJSON.values) {
@@ -682,17 +843,28 @@ function processShellJSON(url, workerID, dataJSON, signalFinish) {
         }
         unindexValues(dataJSON, buffers);
     }
+    if (dataJSON.quantization) {
+        dequantizePoints(dataJSON, buffers.position);
+    }
+    if (dataJSON.octahedral) {
+        unpackNormals(dataJSON, buffers.normals);
+    }
     if (dataJSON.colorsData) {
         uncompressColors(dataJSON, buffers.colors);
     }
+    postShell(url, workerID, dataJSON, buffers, signalFinish);
+}
 
+function postShell(url, workerID, dataJSON, buffers, signalFinish) {
     var parts = url.split("/");
+    var transfer = [buffers.position.buffer, buffers.normals.buffer, buffers.colors.buffer];
+    if (buffers.index) transfer.push(buffers.index.buffer);
     self.postMessage({
         type: "shellLoad",
         data: buffers,
         id: dataJSON.id,
         workerID: workerID
-    }, [buffers.position.buffer, buffers.normals.buffer, buffers.colors.buffer]);
+    }, transfer);
     // Do we signal that we are all done
     if (signalFinish) {
         self.postMessage({
@@ -0,0 +1,47 @@
+"""Tests of the TySON batch reader.  Run with: python -m unittest discover
+test"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from tyson import BatchReader, TysonEncoder, numpy
+
+
+class BatchReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'batch0.tyson')
+        batch = {'shells': [
+            {'id': 'sh%d' % i, 'size': 100,
+             'pointsIndex': [(i * 7 + j) % 1000 for j in range(300)]}
+            for i in range(3)]}
+        with open(self.path, 'wb') as f:
+            TysonEncoder().encode(batch, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_arrays_outlive_reader(self):
+        for arrays in (None, 'array', 'list'):
+            with BatchReader(self.path, arrays=arrays) as reader:
+                shell = reader.shell('sh1')
+            expected = [(7 + j) % 1000 for j in range(300)]
+            self.assertEqual(list(shell['pointsIndex']), expected)
+            self.assertEqual(sum(shell['pointsIndex']), sum(expected))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy_views_outlive_reader(self):
+        with BatchReader(self.path, arrays='numpy') as reader:
+            shells = [reader.shell(x) for x in reader.shell_ids()]
+        for i, shell in enumerate(shells):
+            expected = sum((i * 7 + j) % 1000 for j in range(300))
+            self.assertEqual(int(shell['pointsIndex'].sum()), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
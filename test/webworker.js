@@ -0,0 +1,56 @@
+/* Decodes TySON batches with the model loading web worker, and checks that
+ * delta coded batches load the same shells as plain ones.
+ *
+ * The fixtures are one batch of a small synthetic model, converted by
+ *   scripts/benchmark.py model --shells 2 --triangles 200 --depth 1 \
+ *       --annotations 0 --colors 2 --keep DIR
+ *   scripts/xmlToJson.py DIR index.xml -b 1 -t [-z]
+ * without and with -z.  Run with: node test/webworker.js
+ */
+"use strict";
+var assert = require('assert');
+var fs = require('fs');
+var path = require('path');
+var vm = require('vm');
+
+var workerPath = path.join(__dirname, '../src/client/models/webworker.js');
+
+// Runs the worker with a stand-in for its global scope, returning the
+// shells it posts for a batch
+function loadBatch(name) {
+    var messages = [];
+    var sandbox = {
+        console: console,
+        self: {
+            addEventListener: function () {},
+            postMessage: function (message) { messages.push(message); }
+        }
+    };
+    vm.runInNewContext(fs.readFileSync(workerPath, 'utf8'), sandbox);
+    var file = fs.readFileSync(path.join(__dirname, 'fixtures', name));
+    var buffer = file.buffer.slice(file.byteOffset,
+        file.byteOffset + file.length);
+    sandbox.processBatchTYSON(name, 0, buffer);
+    var shells = {};
+    messages.forEach(function (message) {
+        if (message.type === "shellLoad") {
+            shells[message.id] = message.data;
+        }
+    });
+    return shells;
+}
+
+var plain = loadBatch('batch.tyson');
+var delta = loadBatch('batch.delta.tyson');
+assert.deepEqual(Object.keys(delta).sort(), Object.keys(plain).sort());
+assert.ok(Object.keys(plain).length > 0, "no shells loaded");
+Object.keys(plain).forEach(function (id) {
+    ['position', 'normals', 'colors'].forEach(function (key) {
+        var expected = Array.from(plain[id][key]);
+        var actual = Array.from(delta[id][key]);
+        assert.ok(expected.length > 0, id + " has no " + key);
+        assert.deepEqual(actual, expected,
+            "delta coded " + key + " of shell " + id + " differ");
+    });
+});
+console.log("webworker: delta coded batches load the same shells");